@@ -0,0 +1,498 @@
+"""Offline load and latency benchmark for the bot's message path.
+
+Drives the real handlers (`handle_message`, and `start_command`/`name`/`phone` for registrations)
+with synthetic updates. The external services are replaced by local fakes with configurable latency:
+- a chat model and an embedding model that sleep before answering and count their calls;
+- an in-process stand-in for the Mongo users and vector collections that counts round trips, with
+  a pymongo-like and a motor-like interface over the same documents.
+The vector collection is exported with rag.local_index, so retrieval runs through the normal chain.
+
+The workload is generated from --seed, so two runs with the same arguments send the same messages.
+
+Usage: python benchmarks/message_path.py [--messages N] [--concurrency N] [--llm-latency S] ...
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+import statistics
+import threading
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, List, Optional
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Placeholders for the variables the bot modules read at import time
+for _key, _value in {"TOKEN": "123456:benchmark", "ADMIN_USER_ID": "0", "BOT_USERNAME": "benchmark_bot",
+                     "MONGO_CLIENT": "mongodb://localhost:27017", "DATABASE_NAME": "benchmark",
+                     "COLLECTION_NAME": "vectors", "INDEX_NAME": "benchmark"}.items():
+    os.environ.setdefault(_key, _value)
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+COUNTRIES = ["United States", "United Kingdom", "Germany", "South Korea", "Japan", "France", "Canada", "Australia"]
+WORDS = ["Northern", "Central", "Royal", "Pacific", "Eastern", "Western", "Southern", "Atlantic", "Alpine", "Capital",
+         "Lakeside", "Highland", "Coastal", "Metropolitan", "Riverside", "Summit", "Valley", "Harbor", "Meadow", "Crown"]
+
+
+# ---------------------------------------------------------------- fakes
+
+class Stats:
+    """Call counters shared by all fakes. Fakes may be called from worker threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mongo_round_trips = 0
+        self.llm_calls = 0
+        self.embedding_calls = 0
+
+    def add(self, field: str, amount: int = 1):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"mongo_round_trips": self.mongo_round_trips, "llm_calls": self.llm_calls,
+                    "embedding_calls": self.embedding_calls}
+
+
+STATS = Stats()
+
+
+class FakeCollection:
+    """Just enough of a pymongo Collection for the bot: find, find_one, update_one and bulk_write."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.docs = {}
+
+    def _round_trip(self):
+        STATS.add("mongo_round_trips")
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _matches(doc: dict, query: dict) -> bool:
+        for field, expected in query.items():
+            if isinstance(expected, dict) and "$exists" in expected:
+                if (field in doc) != expected["$exists"]:
+                    return False
+            elif isinstance(expected, dict) and "$in" in expected:
+                if doc.get(field) not in expected["$in"]:
+                    return False
+            elif doc.get(field) != expected:
+                return False
+        return True
+
+    def _find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> List[dict]:
+        docs = [dict(doc) for doc in self.docs.values() if self._matches(doc, query or {})]
+        if projection:
+            keep = [field for field, flag in projection.items() if flag]
+            if keep:
+                docs = [{field: doc[field] for field in keep + ["_id"] if field in doc} for doc in docs]
+        return docs
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None):
+        self._round_trip()
+        return self._find(query, projection)
+
+    def find_one(self, query: dict):
+        self._round_trip()
+        return next(iter(self._find(query)), None)
+
+    def _update(self, query: dict, update: dict, upsert: bool = False):
+        doc = self.docs.get(query["_id"])
+        if doc is None:
+            if not upsert:
+                return
+            doc = self.docs[query["_id"]] = {"_id": query["_id"]}
+        doc.update(update.get("$set", {}))
+        for field, delta in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + delta
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False):
+        self._round_trip()
+        self._update(query, update, upsert)
+
+    def _bulk_update(self, operations):
+        for operation in operations:
+            self._update(operation._filter, operation._doc, getattr(operation, "_upsert", False) or False)
+
+    def bulk_write(self, operations, ordered: bool = True):
+        self._round_trip()
+        self._bulk_update(operations)
+
+
+class FakeClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._collections = {}
+
+    def __getitem__(self, db_name: str):
+        client = self
+
+        class _Database:
+            def __getitem__(self, name: str) -> FakeCollection:
+                return client._collections.setdefault((db_name, name), FakeCollection(client.latency))
+
+        return _Database()
+
+
+class FakeAsyncCursor:
+    def __init__(self, collection: "FakeAsyncCollection", query: Optional[dict], projection: Optional[dict]):
+        self._collection, self._query, self._projection = collection, query, projection
+
+    async def to_list(self, length: Optional[int] = None):
+        await self._collection._round_trip()
+        return self._collection.sync._find(self._query, self._projection)[:length]
+
+
+class FakeAsyncCollection:
+    """The motor counterpart of FakeCollection, over the same documents. Latency is awaited, not slept."""
+
+    def __init__(self, sync: FakeCollection):
+        self.sync = sync
+
+    async def _round_trip(self):
+        STATS.add("mongo_round_trips")
+        if self.sync.latency:
+            await asyncio.sleep(self.sync.latency)
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> FakeAsyncCursor:
+        return FakeAsyncCursor(self, query, projection)
+
+    async def find_one(self, query: dict):
+        await self._round_trip()
+        return next(iter(self.sync._find(query)), None)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        await self._round_trip()
+        self.sync._update(query, update, upsert)
+
+    async def bulk_write(self, operations, ordered: bool = True):
+        await self._round_trip()
+        self.sync._bulk_update(operations)
+
+
+class FakeAsyncClient:
+    def __init__(self, client: FakeClient):
+        self.client = client
+
+    def __getitem__(self, db_name: str):
+        database = self.client[db_name]
+
+        class _Database:
+            def __getitem__(self, name: str) -> FakeAsyncCollection:
+                return FakeAsyncCollection(database[name])
+
+        return _Database()
+
+    def close(self):
+        pass
+
+
+class LatencyEmbeddings(Embeddings):
+    """Deterministic hash-seeded vectors, returned after a fixed latency per request."""
+
+    def __init__(self, latency: float, dimensions: int = 768):
+        self.latency = latency
+        self.dimensions = dimensions
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha1(text.casefold().encode()).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        STATS.add("embedding_calls")
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class LatencyChatModel(BaseChatModel):
+    """Chat model that answers with a fixed text after a time-to-first-token and per-token delay."""
+
+    first_token_latency: float = 1.0
+    token_latency: float = 0.01
+    answer: str = ("Hello! 👋 QS World University Rank: 42 • Times Higher Education Rank: 57 • "
+                   "US News & World Report Rank: 63. Any other university you'd like to know about? 🎓")
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-latency"
+
+    def _tokens(self) -> List[str]:
+        return [word + " " for word in self.answer.split()]
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        STATS.add("llm_calls")
+        time.sleep(self.first_token_latency + self.token_latency * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        STATS.add("llm_calls")
+        await asyncio.sleep(self.first_token_latency + self.token_latency * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        STATS.add("llm_calls")
+        await asyncio.sleep(self.first_token_latency)
+        for token in self._tokens():
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class FakeMessage:
+    """The parts of telegram.Message the handlers use; replies are recorded, not sent."""
+
+    def __init__(self, user_id: int, text: Optional[str], chat_type: str = "private", contact=None):
+        self.from_user = SimpleNamespace(id=user_id, username=f"user{user_id}")
+        self.chat = SimpleNamespace(id=user_id, type=chat_type, send_action=self._send_action)
+        self.text = text
+        self.contact = contact
+        self.replies: List[str] = []
+        self.first_reply_at: Optional[float] = None
+
+    async def _send_action(self, action):
+        pass
+
+    async def reply_text(self, text: str, **kwargs):
+        if self.first_reply_at is None:
+            self.first_reply_at = time.perf_counter()
+        self.replies.append(text)
+        return self
+
+    async def edit_text(self, text: str, **kwargs):
+        self.replies.append(text)
+
+
+def fake_update(message: FakeMessage):
+    return SimpleNamespace(message=message, effective_user=message.from_user, effective_chat=message.chat)
+
+
+# ---------------------------------------------------------------- workload
+
+def synthetic_rankings(count: int, rng: random.Random):
+    """QS, THE and US News lists over the same `count` universities, with shuffled ranks."""
+    names, seen = [], set()
+    while len(names) < count:
+        name = f"{rng.choice(WORDS)} {rng.choice(WORDS)} University"
+        if name not in seen:
+            seen.add(name)
+            names.append((name, rng.choice(COUNTRIES)))
+    lists = []
+    for _ in range(3):
+        order = list(range(count))
+        rng.shuffle(order)
+        lists.append([{"rank": rank + 1, "university": names[idx][0], "country": names[idx][1]}
+                      for rank, idx in enumerate(order)])
+    return names, lists
+
+
+def build_workload(names, messages: int, rag_ratio: float, repeat_ratio: float, rng: random.Random):
+    """Rank questions the index can answer, and free-form questions that need the RAG chain."""
+    workload, asked = [], []
+    for _ in range(messages):
+        if asked and rng.random() < repeat_ratio:
+            workload.append(rng.choice(asked))
+            continue
+        name, country = rng.choice(names)
+        if rng.random() < rag_ratio:
+            # No university name in it, so only the RAG chain can answer
+            text = f"Which universities in {country} are strong in engineering? (question {rng.randint(0, 10**6)})"
+            asked.append(text)
+        else:
+            text = rng.choice([name, name.upper(), f"What is the rank of {name}?"])
+        workload.append(text)
+    return workload
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+def latency_summary(samples: List[float]) -> dict:
+    if not samples:
+        return {}
+    return {"p50_ms": round(percentile(samples, 50) * 1000, 2), "p95_ms": round(percentile(samples, 95) * 1000, 2),
+            "p99_ms": round(percentile(samples, 99) * 1000, 2), "mean_ms": round(statistics.mean(samples) * 1000, 2)}
+
+
+# ---------------------------------------------------------------- runs
+
+async def run_messages(handlers, workload: List[str], concurrency: int, user_ids: List[int]):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_byte = [], []
+
+    async def one(idx: int, text: str):
+        async with semaphore:
+            message = FakeMessage(user_ids[idx % len(user_ids)], text)
+            context = SimpleNamespace(user_data={}, bot=None)
+            started = time.perf_counter()
+            await handlers.handle_message(fake_update(message), context)
+            latencies.append(time.perf_counter() - started)
+            if message.first_reply_at is not None:
+                first_byte.append(message.first_reply_at - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(idx, text) for idx, text in enumerate(workload)))
+    return latencies, first_byte, time.perf_counter() - started
+
+
+async def run_registrations(handlers, count: int, concurrency: int, first_user_id: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(user_id: int):
+        async with semaphore:
+            context = SimpleNamespace(user_data={}, bot=None)
+            started = time.perf_counter()
+            await handlers.start_command(fake_update(FakeMessage(user_id, "/start")), context)
+            await handlers.name(fake_update(FakeMessage(user_id, f"User {user_id}")), context)
+            contact = SimpleNamespace(phone_number=f"+99890{user_id:07d}")
+            await handlers.phone(fake_update(FakeMessage(user_id, None, contact=contact)), context)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(first_user_id + idx) for idx in range(count)))
+    return latencies, time.perf_counter() - started
+
+
+async def benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    # Configure the bot modules through their environment variables, before they are imported
+    index_dir = tempfile.mkdtemp(prefix="elyuf-bench-")
+    os.environ.update({
+        "RAG_VECTOR_BACKEND": "local",
+        "LOCAL_INDEX_PATH": os.path.join(index_dir, "rankings"),
+        "RAG_MAX_CONCURRENCY": str(args.rag_concurrency),
+        "STREAM_ANSWERS": "1" if args.stream else "0",
+        "STREAM_EDIT_INTERVAL": "0",
+    })
+    names, (qs, times, us_news) = synthetic_rankings(args.universities, rng)
+
+    # Mongo stand-in, shared by the users and vector collections like the real pooled client
+    from rag import mongodb_database
+    client = FakeClient(args.mongo_latency)
+    mongodb_database._client = client
+    mongodb_database._async_client = FakeAsyncClient(client)
+    users = client["elyufbot"]["users"]
+    registered = list(range(1, args.users + 1))
+    for user_id in registered:
+        users.docs[user_id] = {"_id": user_id, "search_count": 0, "roadmap_presses": 0, "survey_count": 0}
+
+    # Vector collection: one document per ranking row, exported to a local index for retrieval
+    from rag.ranking_index import RankingIndex, normalize_name
+    embeddings = LatencyEmbeddings(0.0)
+    vectors = client[os.environ["DATABASE_NAME"]][os.environ["COLLECTION_NAME"]]
+    for source, items in (("QS", qs), ("THE", times), ("US News", us_news)):
+        for item in items:
+            text = f" Source: {source}, Rank: {item['rank']}, University: {item['university']}, Country: {item['country']}"
+            doc_id = hashlib.sha1(text.encode()).hexdigest()
+            vectors.docs[doc_id] = {"_id": doc_id, "text": text, "embedding": embeddings.embed_query(text),
+                                    "source": source, "university_key": normalize_name(item["university"]), **item}
+    from rag.local_index import export_index, LOCAL_INDEX_PATH
+    export_index(vectors, LOCAL_INDEX_PATH)
+
+    # The fake models take the place of the lazily built Vertex AI ones
+    from rag import query_util
+    query_util._embeddings = LatencyEmbeddings(args.embed_latency)
+    query_util._llm = LatencyChatModel(first_token_latency=args.llm_latency, token_latency=args.token_latency)
+
+    # The ranking index is built from the synthetic lists instead of the data/ JSON files
+    from rag import ranking_index as ranking_index_module
+    from telegram_src import handlers
+    # Both the handler's direct answers and hybrid retrieval look names up in it
+    ranking_index_module._ranking_index = RankingIndex.from_sources(qs, times, us_news)
+    from usage_counters import usage_counters
+    from user_database import user_registry
+    await user_registry.aensure_loaded()
+
+    # Build the chain outside the measurement, the bot does the same in its startup warm-up
+    query_util.get_rag_chain()
+    workload = build_workload(names, args.messages, args.rag_ratio, args.repeat_ratio, rng)
+    query_util.answer_cache.invalidate()
+
+    await usage_counters.start()
+    before = STATS.snapshot()
+    latencies, first_byte, elapsed = await run_messages(handlers, workload, args.concurrency, registered)
+    await usage_counters.stop()
+    after = STATS.snapshot()
+
+    before_registrations = STATS.snapshot()
+    registration_latencies, registration_elapsed = await run_registrations(
+        handlers, args.registrations, args.concurrency, args.users + 1)
+    after_registrations = STATS.snapshot()
+
+    messages = len(workload)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "messages": {
+            "count": messages,
+            "latency": latency_summary(latencies),
+            "time_to_first_reply": latency_summary(first_byte),
+            "messages_per_second": round(messages / elapsed, 2),
+            "mongo_round_trips_per_message": round((after["mongo_round_trips"] - before["mongo_round_trips"]) / messages, 3),
+            "llm_calls_per_message": round((after["llm_calls"] - before["llm_calls"]) / messages, 3),
+            "embedding_calls_per_message": round((after["embedding_calls"] - before["embedding_calls"]) / messages, 3),
+            "answer_cache": query_util.answer_cache.stats(),
+        },
+        "registrations": {
+            "count": args.registrations,
+            "latency": latency_summary(registration_latencies),
+            "registrations_per_second": round(args.registrations / registration_elapsed, 2) if args.registrations else 0,
+            "mongo_round_trips_per_registration": round(
+                (after_registrations["mongo_round_trips"] - before_registrations["mongo_round_trips"])
+                / max(args.registrations, 1), 3),
+        },
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline latency and throughput benchmark for the message path.")
+    parser.add_argument("--messages", type=int, default=500, help="Messages sent through handle_message")
+    parser.add_argument("--registrations", type=int, default=50, help="/start -> name -> phone flows")
+    parser.add_argument("--concurrency", type=int, default=32, help="Messages in flight at once")
+    parser.add_argument("--rag-concurrency", type=int, default=8, help="RAG lookups in flight (RAG_MAX_CONCURRENCY)")
+    parser.add_argument("--users", type=int, default=1000, help="Registered users in the fake users collection")
+    parser.add_argument("--universities", type=int, default=300, help="Universities in the synthetic rankings")
+    parser.add_argument("--rag-ratio", type=float, default=0.3, help="Share of questions the index can't answer")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="Share of messages repeating an earlier one")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="Seconds to the first generated token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="Seconds per generated token")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Seconds per embedding request")
+    parser.add_argument("--mongo-latency", type=float, default=0.02, help="Seconds per Mongo round trip")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Stream RAG answers, as the bot does by default (--no-stream for STREAM_ANSWERS=0)")
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the synthetic data and workload")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    results = asyncio.run(benchmark(args))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Startup benchmark: import time of the bot modules and time from process start to polling.
+
+Every sample runs in a fresh interpreter, so module caches from one sample never help the next.
+Time-to-first-poll is measured up to the moment main.py calls `Application.run_polling`, which is
+replaced by a marker that reports the time and exits, so no Telegram, Mongo or Vertex AI access is
+needed. Placeholder values are used for any required environment variable that isn't set.
+
+Usage: python benchmarks/startup.py [--runs N]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLACEHOLDER_ENV = {
+    "TOKEN": "123456:benchmark",
+    "ADMIN_USER_ID": "0",
+    "BOT_USERNAME": "benchmark_bot",
+    "MONGO_CLIENT": "mongodb://localhost:27017",
+    "DATABASE_NAME": "benchmark",
+    "COLLECTION_NAME": "benchmark",
+    "INDEX_NAME": "benchmark",
+}
+
+IMPORT_SCRIPT = """
+import time, json
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - started}}))
+"""
+
+# Runs main.py as __main__ with run_polling swapped for a marker that prints the wall clock time
+FIRST_POLL_SCRIPT = """
+import sys, time, json, runpy
+from telegram.ext import Application
+
+def run_polling(self, *args, **kwargs):
+    print(json.dumps({"reached_at": time.time()}))
+    sys.stdout.flush()
+    raise SystemExit(0)
+
+Application.run_polling = run_polling
+runpy.run_path("main.py", run_name="__main__")
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    for key, value in PLACEHOLDER_ENV.items():
+        env.setdefault(key, value)
+    return env
+
+
+def _last_json_line(output: str) -> dict:
+    for line in reversed(output.strip().splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    raise RuntimeError(f"No result in benchmark output:\n{output}")
+
+
+def measure_import(module: str) -> float:
+    result = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(module=module)], cwd=REPO_ROOT, env=_env(),
+                            capture_output=True, text=True, check=True)
+    return _last_json_line(result.stdout)["seconds"]
+
+
+def measure_first_poll() -> float:
+    started = time.time()
+    result = subprocess.run([sys.executable, "-c", FIRST_POLL_SCRIPT], cwd=REPO_ROOT, env=_env(),
+                            capture_output=True, text=True, check=True)
+    return _last_json_line(result.stdout)["reached_at"] - started
+
+
+def _summary(samples):
+    return {"median_ms": round(statistics.median(samples) * 1000, 1), "min_ms": round(min(samples) * 1000, 1),
+            "max_ms": round(max(samples) * 1000, 1), "runs": len(samples)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure bot import time and time to first poll.")
+    parser.add_argument("--runs", type=int, default=5, help="Samples per measurement")
+    args = parser.parse_args(argv)
+
+    results = {
+        "import telegram_src.handlers": _summary([measure_import("telegram_src.handlers") for _ in range(args.runs)]),
+        "import main": _summary([measure_import("main") for _ in range(args.runs)]),
+        "process start to run_polling": _summary([measure_first_poll() for _ in range(args.runs)]),
+    }
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
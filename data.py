@@ -1,29 +1,9 @@
-import json
+from ranking_snapshot import load_snapshot
 
 def load_data():
-    """Load data from JSON files.
-    This file's code is used for loading data from JSON files in the data directory.
-    but it is not used in the current implementation as the data is loaded from the database MongoDB."""
-    try:
-        with open("data/init-QS.json") as qs_file:
-            qs_data = json.load(qs_file)["data"]
-    except json.JSONDecodeError as e:
-        print(f"Error loading init-QS.json: {e}")
-        qs_data = []
-
-    try:
-        with open("data/init-Times.json") as times_file:
-            times_data = json.load(times_file)["data"]
-    except json.JSONDecodeError as e:
-        print(f"Error loading init-Times.json: {e}")
-        times_data = []
-
-    try:
-        with open("data/init-US&NEWS.json") as us_news_file:
-            us_news_data = json.load(us_news_file)["data"]
-    except json.JSONDecodeError as e:
-        print(f"Error loading init-US&NEWS.json: {e}")
-        us_news_data = [] 
-
+    """Load the QS, Times and US News rankings from the data directory.
+    The JSON files are read through the compiled snapshot in data/rankings.snapshot (see ranking_snapshot.py),
+    which is rebuilt automatically whenever one of the files changes. A file that isn't valid JSON loads as an empty list."""
+    snapshot = load_snapshot()
+    qs_data, times_data, us_news_data = (snapshot.items(position) for position in range(3))
     return qs_data, times_data, us_news_data, 
-
@@ -1,34 +1,35 @@
 import os
-import json
+import sys
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Function to load JSON data
-def load_json_data(file_path):
-    """Count the number of universities in a JSON file. Not used in the current implementation. only once used during
-    the development of the project in the data directory."""
-    with open(file_path, 'r', encoding="utf-8") as file:
-        return json.load(file)
+# The repository root, so the script runs from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ranking_snapshot import directory_sources, load_snapshot
 
-directory_path = "/Users/mukhsinmukhtorov/Desktop/Elyuf/data"
-json_files = [f for f in os.listdir(directory_path) if f.endswith('.json')]
+# Function to load the ranking data
+def load_ranking_snapshot(directory_path):
+    """Count the number of universities in the JSON files of a directory. Not used in the current implementation. only once used during
+    the development of the project in the data directory. The files are read through the compiled snapshot (see ranking_snapshot.py)."""
+    return load_snapshot(directory_sources(directory_path), os.path.join(directory_path, "rankings.snapshot"))
+
+directory_path = os.getenv("RANKING_DATA_DIR", os.path.dirname(os.path.abspath(__file__)))
+snapshot = load_ranking_snapshot(directory_path)
 
 total_universities = 0
 
-for file in json_files:
-    file_path = os.path.join(directory_path, file)  # Use os.path.join to concatenate paths correctly
-    data = load_json_data(file_path)
-    
-    if 'data' not in data:
-        print(f"Warning: 'data' key not found in {file}")
+for info in snapshot.header["sources"]:
+    if not info["rows"]:
+        print(f"Warning: no rows found in {os.path.basename(info['file'])}")
         continue
-    
-    universities_in_file = len(data['data']['university'])
+
+    universities_in_file = info["rows"]
     total_universities += universities_in_file
-    print(f"Number of universities in {file}: {universities_in_file}")
+    print(f"Number of universities in {os.path.basename(info['file'])}: {universities_in_file}")
 
 print(f"Total number of universities in all JSON files: {total_universities}")
+print(f"Distinct universities across all JSON files: {len(snapshot)}")
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,191 @@
+"""Non-blocking, structured logging for the bot.
+
+`setup_logging()` routes every log record through a bounded queue to a background thread, which
+formats it (JSON lines by default, LOG_FORMAT=text for the old human-readable format) and writes
+it to stdout. The thread that logs only filters the record and puts it on the queue, so formatting
+and terminal I/O never run on the event loop. The overhead is capped: past LOG_MAX_RATE records a
+second, or with LOG_QUEUE_SIZE records waiting, records below WARNING are dropped and counted in
+elyuf_log_records_dropped_total.
+
+Each update gets a trace ID (see `trace`), kept in a context variable, so every record logged
+while handling it carries the same ID, including the ones from retrieval, generation and the
+user database. Events logged with `log_event` can be sampled per event name with
+LOG_SAMPLE="event=rate,...", e.g. LOG_SAMPLE="rag_stage=0.1".
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+import dotenv
+
+from metrics import Counter
+
+# Load environment variables
+dotenv.load_dotenv()
+
+# Logging configuration
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" for one JSON object per line, "text" for the classic format
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records waiting for the writer thread
+LOG_MAX_RATE = float(os.getenv("LOG_MAX_RATE", "2000"))  # Records per second, below WARNING the rest is dropped
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "rag_stage=0.1,db_call=0.1")  # Share of each event's records that is kept
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s"
+
+DROPPED = Counter("elyuf_log_records_dropped_total", "Log records not written", ["reason"])
+
+_trace_id: contextvars.ContextVar = contextvars.ContextVar("trace_id", default=None)
+# Fields added to every record of the process, e.g. the worker number
+_static_fields: Dict[str, object] = {}
+
+
+def get_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+@contextmanager
+def trace(trace_id):
+    """Tag everything logged in this context, including tasks and threads started from it, with trace_id."""
+    token = _trace_id.set(str(trace_id))
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.INFO, **fields):
+    """Log a structured event. The fields become top-level keys of the JSON record."""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"event": event, "fields": fields})
+
+
+def parse_sampling(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        if "=" in part:
+            event, rate = part.split("=", 1)
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Puts records on a bounded queue for a QueueListener, within a records-per-second budget.
+
+    Below WARNING, a record is dropped when its event is sampled out, when the budget of the current
+    second is used up, or when the queue is full. Warnings and errors only give way to a full queue.
+    Records are put on the queue unformatted; the listener thread formats them."""
+
+    def __init__(self, records: queue.Queue, max_rate: float = LOG_MAX_RATE, sampling: Optional[Dict[str, float]] = None):
+        super().__init__(records)
+        self.max_rate = max_rate
+        self.sampling = sampling if sampling is not None else parse_sampling(LOG_SAMPLE)
+        self._second = 0
+        self._count = 0
+
+    def _admit(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.sampling.get(getattr(record, "event", None), 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            DROPPED.inc(reason="sampled")
+            return False
+        second = int(time.monotonic())
+        if second != self._second:
+            self._second, self._count = second, 0
+        self._count += 1
+        if self.max_rate and self._count > self.max_rate:
+            DROPPED.inc(reason="rate")
+            return False
+        return True
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only what depends on the logging context is resolved here, the rest is left to the writer
+        record.trace_id = _trace_id.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(reason="queue_full")
+
+    def emit(self, record: logging.LogRecord):
+        if self._admit(record):
+            super().emit(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, trace ID, event fields and exception."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        entry.update(_static_fields)
+        if getattr(record, "event", None):
+            entry["event"] = record.event
+            entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        record.trace_id = getattr(record, "trace_id", None) or "-"
+        message = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+
+def setup_logging(level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, **static_fields) -> QueueListener:
+    """Route the root logger through the queue and start the writer thread. Safe to call again."""
+    global _listener
+    with _setup_lock:
+        _static_fields.update(static_fields)
+        if _listener is not None:
+            return _listener
+        writer = logging.StreamHandler(sys.stdout)
+        writer.setFormatter(JsonFormatter() if log_format == "json" else _TextFormatter(TEXT_FORMAT))
+        records: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(BoundedQueueHandler(records))
+        root.setLevel(level)
+        # httpx logs every Telegram API request at INFO
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        _listener = QueueListener(records, writer, respect_handler_level=True)
+        _listener.start()
+        # Write what is still queued when the process exits
+        atexit.register(stop_logging)
+        return _listener
+
+
+def stop_logging():
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
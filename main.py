@@ -1,21 +1,100 @@
 import os
+import asyncio
+import logging
 import dotenv 
 from telegram.ext import CommandHandler, ConversationHandler, MessageHandler, filters, Application
-from telegram_src.handlers import start_command, name, phone, admin_password, help_command, restart_command, handle_message, \
-    error, NAME, PHONE, ADMIN
+from telegram_src.update_processing import PerChatUpdateProcessor
+from telegram_src.supervisor import BOT_WORKERS, build_supervisor_application
+from metrics import metrics_service
+from logging_pipeline import setup_logging
+from telegram_src.persistence import BOT_STATE_PATH, StateStore, SQLitePersistence, StateSnapshots
 
 
 dotenv.load_dotenv()
 TOKEN = os.getenv("TOKEN")
 
+# How updates are received: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Updates processed at the same time; updates from the same user are always processed in order
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# Webhook settings, the port is the one published in docker-compose.yml
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public https base URL Telegram sends updates to
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against Telegram's X-Telegram-Bot-Api-Secret-Token header
 
-# Main function to start the bot and add handlers, conversation handlers, and error handlers, and run the bot.
-# The bot will start polling for new messages.
-# The bot will respond to commands and messages from users.
-# This file is just like run.py in PastAPI
-if __name__ == "__main__":
-    print("Starting bot...")
-    app = Application.builder().token(TOKEN).build()
+logger = logging.getLogger(__name__)
+
+# Snapshots of the user registry and the answer cache, when the application has a state store
+state_snapshots = None
+
+
+# Loads the registered users, the ranking index and the RAG chain while the bot is already polling.
+# Until it finishes, the first request that needs one of them builds it on demand.
+async def warm_up():
+    from user_database import user_registry
+    from rag.ranking_index import get_ranking_index
+    from rag.query_util import warm_up as warm_up_rag
+
+    steps = (
+        ("user registry", user_registry.aensure_loaded),
+        ("ranking index", lambda: asyncio.to_thread(get_ranking_index)),
+        ("RAG chain", lambda: asyncio.to_thread(warm_up_rag)),
+    )
+    for name, step in steps:
+        try:
+            await step()
+        except Exception as e:
+            logger.error("Warm-up step %s failed, it will be retried on first use: %s", name, e)
+
+
+# Background tasks that live as long as the bot does
+async def post_init(application: Application):
+    global state_snapshots
+    from usage_counters import usage_counters
+    if isinstance(application.persistence, SQLitePersistence):
+        from user_database import user_registry
+        from rag.query_util import answer_cache
+        # Restored in the background, in chunks, while the bot already answers
+        state_snapshots = StateSnapshots(application.persistence.store, user_registry, answer_cache)
+        application.create_task(state_snapshots.start())
+    await usage_counters.start()
+    # Prometheus /metrics endpoint on METRICS_PORT and the periodic log summary
+    await metrics_service.start()
+    application.create_task(warm_up())
+
+async def post_shutdown(application: Application):
+    from usage_counters import usage_counters
+    from rag.mongodb_database import close_async_client
+    # Write any buffered usage counters before exiting
+    await usage_counters.stop()
+    if state_snapshots is not None:
+        await state_snapshots.stop()
+    await metrics_service.stop()
+    close_async_client()
+
+
+# Build the application and register handlers, conversation handlers, and error handlers.
+# Worker processes build it without an updater, the supervisor passes the updates to them.
+# Conversations and user_data are kept in the SQLite state store at state_path, unless it is empty.
+# The handlers, and through them the RAG chain and the user database, are imported here, so the
+# supervisor, which imports this module too, never loads them.
+def build_application(with_updater: bool = True, state_path: str = BOT_STATE_PATH) -> Application:
+    from telegram_src.handlers import start_command, name, phone, admin_password, help_command, restart_command, \
+        handle_message, error, NAME, PHONE, ADMIN
+
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    if state_path:
+        builder = builder.persistence(SQLitePersistence(StateStore(state_path)))
+    app = builder.build()
 
     # Command Handlers
     app.add_handler(CommandHandler("help", help_command))
@@ -31,15 +110,51 @@ if __name__ == "__main__":
             ADMIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_password)],
         },
         fallbacks=[CommandHandler("start", start_command)],
+        # Half-finished registrations survive a restart
+        name="registration",
+        persistent=bool(state_path),
     )
     app.add_handler(conv_handler)
 
     # Message Handler
+    # Lookups of different users overlap through the update processor, one user's messages are answered in order
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Error Handler
     app.add_error_handler(error)
+    return app
+
+
+# Main function to start the bot and run it.
+# The bot will start polling for new messages, or serve a webhook endpoint when BOT_MODE=webhook.
+# The bot will respond to commands and messages from users.
+# This file is just like run.py in PastAPI
+if __name__ == "__main__":
+    # JSON records written by a background thread, see logging_pipeline.py
+    setup_logging()
+    logger.info("Starting bot...")
+    if BOT_WORKERS > 1:
+        # Multi-process mode, see telegram_src/supervisor.py
+        logger.info("Dispatching updates to %d worker processes...", BOT_WORKERS)
+        app = build_supervisor_application(TOKEN, BOT_WORKERS)
+    else:
+        app = build_application()
 
-    # Polling
-    print("Polling...")
-    app.run_polling(poll_interval=1)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        logger.info("Serving webhook on port %d...", WEBHOOK_PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=CONCURRENT_UPDATES,
+        )
+    elif BOT_MODE == "polling":
+        # Polling
+        logger.info("Polling...")
+        app.run_polling(poll_interval=1)
+    else:
+        raise ValueError(f"Unknown BOT_MODE: {BOT_MODE}")
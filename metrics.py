@@ -0,0 +1,276 @@
+"""Hot-path metrics for the bot, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are kept in process and rendered on GET /metrics by a small asyncio
+HTTP server (METRICS_PORT). A periodic summary of the same numbers can also be logged
+(METRICS_LOG_INTERVAL). Metric updates are plain in-memory operations guarded by a lock, so they are
+safe from the worker threads the RAG chain runs in.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import dotenv
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # 0 disables the /metrics endpoint
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))  # Seconds between log summaries, 0 disables
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return super().render() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        # A gauge backed by a function is read when the metrics are rendered
+        self._function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def value(self, **labels) -> float:
+        if self._function is not None:
+            return float(self._function())
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        if self._function is not None:
+            try:
+                return super().render() + [f"{self.name} {float(self._function())}"]
+            except Exception as e:
+                logger.warning("Could not read gauge %s: %s", self.name, e)
+                return []
+        with self._lock:
+            items = sorted(self._values.items())
+        return super().render() + [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket..., count above the last bucket], sum, count
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return entry[2] if entry else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, for log summaries."""
+        entry = self._values.get(self._key(labels))
+        if not entry or not entry[2]:
+            return None
+        target, seen = q * entry[2], 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), entry[0]):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def label_sets(self) -> List[Dict[str, str]]:
+        return [dict(zip(self.labelnames, key)) for key in sorted(self._values)]
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items())
+        lines = super().render()
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Metrics of the message path
+MESSAGES = Counter("elyuf_messages_total", "Messages answered, by how the answer was produced", ["path"])
+MESSAGE_ERRORS = Counter("elyuf_message_errors_total", "Messages that failed in the handler")
+MESSAGE_LATENCY = Histogram("elyuf_message_seconds", "Time from receiving a message to the complete answer", ["path"])
+IN_FLIGHT = Gauge("elyuf_in_flight_requests", "Messages currently being handled")
+STAGE_LATENCY = Histogram("elyuf_stage_seconds", "Latency of individual stages of the message path", ["stage"])
+LLM_CALLS = Counter("elyuf_llm_calls_total", "LLM calls, by the stage that made them", ["stage"])
+LLM_CALLS_PER_REQUEST = Histogram("elyuf_llm_calls_per_request", "LLM calls made for one RAG lookup",
+                                  buckets=(0, 1, 2, 3, 4, 6, 8, 12))
+LLM_TOKENS = Counter("elyuf_llm_tokens_total", "LLM tokens used", ["kind"])
+DB_WRITES = Counter("elyuf_db_writes_total", "Writes to the users collection", ["operation"])
+
+
+def log_summary():
+    parts = [f"in_flight={IN_FLIGHT.value():.0f}", f"errors={MESSAGE_ERRORS.total():.0f}"]
+    for labels in MESSAGE_LATENCY.label_sets():
+        parts.append(f"{labels['path']}: n={MESSAGE_LATENCY.count(**labels)} "
+                     f"p50<={MESSAGE_LATENCY.quantile(0.5, **labels)}s p95<={MESSAGE_LATENCY.quantile(0.95, **labels)}s")
+    for labels in STAGE_LATENCY.label_sets():
+        parts.append(f"{labels['stage']}: p95<={STAGE_LATENCY.quantile(0.95, **labels)}s")
+    parts.append(f"llm_calls={LLM_CALLS.total():.0f} tokens={LLM_TOKENS.total():.0f}")
+    logger.info("Metrics summary | %s", " | ".join(parts))
+
+
+async def _handle_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Drain the headers, the endpoint doesn't need any of them
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", "Not Found\n"
+        payload = body.encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class MetricsService:
+    """Serves /metrics and logs periodic summaries for as long as the bot runs."""
+
+    def __init__(self, port: int = METRICS_PORT, log_interval: float = METRICS_LOG_INTERVAL):
+        self.port = port
+        self.log_interval = log_interval
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._log_task: Optional[asyncio.Task] = None
+
+    async def _log_loop(self):
+        while True:
+            await asyncio.sleep(self.log_interval)
+            log_summary()
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(_handle_http, "0.0.0.0", self.port)
+            logger.info("Serving metrics on :%d/metrics", self.port)
+        if self.log_interval > 0:
+            self._log_task = asyncio.create_task(self._log_loop())
+
+    async def stop(self):
+        if self._log_task is not None:
+            self._log_task.cancel()
+            self._log_task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics_service = MetricsService()
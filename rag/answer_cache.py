@@ -0,0 +1,217 @@
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import dotenv
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Answer cache configuration
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2048"))  # Maximum number of cached answers
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))  # Seconds an answer stays valid
+ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "0") == "1"  # Also match paraphrases by embedding
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # Cosine similarity for a paraphrase hit
+
+# Touched by the ingestion script whenever the embeddings are rebuilt, so cached answers get dropped
+EMBEDDINGS_STAMP_FILE = os.getenv(
+    "EMBEDDINGS_STAMP_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embeddings-version")
+)
+
+
+def bump_embeddings_version():
+    """Mark the embeddings as rebuilt. Running bots notice within a few seconds and clear their caches."""
+    with open(EMBEDDINGS_STAMP_FILE, "w") as stamp:
+        stamp.write(str(time.time()))
+
+
+def _embeddings_version() -> float:
+    try:
+        return os.stat(EMBEDDINGS_STAMP_FILE).st_mtime
+    except OSError:
+        return 0.0
+
+
+def cache_key(text: str, bot_username: Optional[str] = None) -> str:
+    """Cache key for a question: bot mention removed, case-folded, whitespace collapsed."""
+    if bot_username:
+        text = re.sub(f"@{re.escape(bot_username)}", " ", text, flags=re.IGNORECASE)
+    return " ".join(text.casefold().split()).strip(" ?!.")
+
+
+class _Entry:
+    __slots__ = ("answer", "expires_at", "vector")
+
+    def __init__(self, answer: str, expires_at: float, vector: Optional[np.ndarray]):
+        self.answer = answer
+        self.expires_at = expires_at
+        self.vector = vector
+
+
+class AnswerCache:
+    """Bounded LRU cache of final answers with a TTL, keyed by the normalized question.
+
+    With an embedding function, misses on the exact key are matched against the cached questions by
+    cosine similarity, so a paraphrase of a cached question is a hit as well."""
+
+    def __init__(
+        self,
+        maxsize: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+        version_check_interval: float = 5.0,
+        bot_username: Optional[str] = os.getenv("BOT_USERNAME"),
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity = similarity
+        self.version_check_interval = version_check_interval
+        self.bot_username = bot_username
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # Query vectors computed by a semantic miss, reused by the put() that follows it
+        self._pending_vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._version = _embeddings_version()
+        self._version_checked_at = time.monotonic()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self):
+        """Drop every cached answer, e.g. after the embeddings were rebuilt."""
+        self._entries.clear()
+        self._pending_vectors.clear()
+        self.invalidations += 1
+        logger.info("Answer cache invalidated")
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        version = _embeddings_version()
+        if version != self._version:
+            self._version = version
+            self.invalidate()
+
+    def _get_exact(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry.answer
+
+    def _get_similar(self, vector: np.ndarray) -> Optional[str]:
+        now = time.monotonic()
+        keys = [key for key, entry in self._entries.items() if entry.vector is not None and entry.expires_at > now]
+        if not keys:
+            return None
+        matrix = np.stack([self._entries[key].vector for key in keys])
+        scores = matrix @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        self._entries.move_to_end(keys[best])
+        return self._entries[keys[best]].answer
+
+    async def get(self, query: str) -> Optional[str]:
+        self._check_version()
+        key = cache_key(query, self.bot_username)
+        answer = self._get_exact(key)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        if self.embed is not None and self._entries:
+            vector = await self._embed(key)
+            if vector is not None:
+                answer = self._get_similar(vector)
+                if answer is not None:
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return answer
+                self._pending_vectors[key] = vector
+                while len(self._pending_vectors) > 256:
+                    self._pending_vectors.popitem(last=False)
+        self.misses += 1
+        return None
+
+    async def put(self, query: str, answer: str):
+        key = cache_key(query, self.bot_username)
+        vector = None
+        if self.embed is not None:
+            vector = self._pending_vectors.pop(key, None)
+            if vector is None:
+                vector = await self._embed(key)
+        self._entries[key] = _Entry(answer, time.monotonic() + self.ttl, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def embeddings_version(self) -> float:
+        return self._version
+
+    def export(self) -> List[Tuple[str, str, float, Optional[np.ndarray]]]:
+        """(key, answer, expiry as wall-clock time, vector) of the live entries, most recently used first."""
+        now, wall = time.monotonic(), time.time()
+        return [(key, entry.answer, wall + entry.expires_at - now, entry.vector)
+                for key, entry in reversed(self._entries.items()) if entry.expires_at > now]
+
+    def restore(self, entries: Iterable[Tuple[str, str, float, Optional[np.ndarray]]]) -> int:
+        """Add exported entries, most recently used first, behind the ones cached since startup.
+
+        Keys already cached keep their newer answer. Returns how many entries were added; restoring
+        stops once the cache is full."""
+        now, wall = time.monotonic(), time.time()
+        added = 0
+        for key, answer, expires_at, vector in entries:
+            if len(self._entries) >= self.maxsize:
+                break
+            if key in self._entries or expires_at <= wall:
+                continue
+            self._entries[key] = _Entry(answer, now + expires_at - wall, vector)
+            # Every restored entry is older than everything before it
+            self._entries.move_to_end(key, last=False)
+            added += 1
+        return added
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        try:
+            vector = np.asarray(await asyncio.to_thread(self.embed, text), dtype=np.float32)
+        except Exception as e:
+            logger.warning("Could not embed query for the answer cache: %s", e)
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
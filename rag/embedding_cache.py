@@ -0,0 +1,237 @@
+"""Persistent cache of embedding vectors, shared by the bot and the ingestion job.
+
+Vectors are stored as float32 blobs in a SQLite file, keyed by model, kind (query or document, which
+Vertex AI embeds with different task types) and the SHA-256 of the text. The file is capped at
+EMBEDDING_CACHE_MAX_ENTRIES vectors; past that, the least recently used ones are evicted.
+
+Usage: python -m rag.embedding_cache [stats|clear]
+"""
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import dotenv
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from metrics import Counter
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Embedding cache configuration
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "1") == "1"  # Set to 0 to always call the embedding model
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(REPO_ROOT, "rag", ".embedding-cache.sqlite3"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))  # ~600MB at 768 dimensions
+RECOUNT_INTERVAL = 1000  # Inserts between recounts of the table, which other processes may write to too
+
+LOOKUPS = Counter("elyuf_embedding_cache_lookups_total", "Embedding cache lookups", ["kind", "result"])
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+    """SQLite table of float32 vectors with least-recently-used eviction. Safe to share between threads."""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " namespace TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (namespace, text_hash)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self._since_recount = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get_many(self, namespace: str, hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        found: Dict[bytes, np.ndarray] = {}
+        if not hashes:
+            return found
+        with self._lock:
+            # SQLite limits the number of parameters per statement
+            for start in range(0, len(hashes), 500):
+                chunk = list(hashes[start:start + 500])
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE namespace = ? AND text_hash IN ({placeholders})",
+                    [namespace, *chunk],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE namespace = ? AND text_hash = ?",
+                    [(now, namespace, key) for key in found],
+                )
+        return found
+
+    def put_many(self, namespace: str, items: Iterable[Tuple[bytes, Sequence[float]]]):
+        now = time.time()
+        rows = [(namespace, key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # Inserted and updated rows are written apart, so the row count is known without counting the table
+                inserted = self._conn.executemany(
+                    "INSERT INTO embeddings (namespace, text_hash, vector, last_used) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (namespace, text_hash) DO NOTHING",
+                    rows,
+                ).rowcount
+                if inserted < len(rows):
+                    self._conn.executemany(
+                        "UPDATE embeddings SET vector = ?, last_used = ? WHERE namespace = ? AND text_hash = ?",
+                        [(vector, used, row_namespace, key) for row_namespace, key, vector, used in rows],
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._count += inserted
+            self._since_recount += inserted
+            if self._count > self.max_entries or self._since_recount >= RECOUNT_INTERVAL:
+                # Another process (the ingestion job, a second worker) may write to the same file
+                self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                self._since_recount = 0
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the cap so the next inserts don't evict again straight away
+        excess = self._count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE (namespace, text_hash) IN"
+            " (SELECT namespace, text_hash FROM embeddings ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        self._count -= excess
+        logger.info("Evicted %d embeddings from the cache", excess)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that answers repeated texts from an EmbeddingStore.
+
+    `embed_documents` looks up every text in one query and sends only the distinct misses to the
+    wrapped model, in a single `embed_documents` call. A store that can't be read or written is
+    logged and bypassed, so the cache never makes embedding fail."""
+
+    def __init__(self, underlying: Embeddings, model_name: str, store: EmbeddingStore):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.store = store
+
+    def _lookup(self, namespace: str, hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        try:
+            return self.store.get_many(namespace, hashes)
+        except sqlite3.Error as e:
+            logger.warning("Embedding cache lookup failed: %s", e)
+            return {}
+
+    def _save(self, namespace: str, items: List[Tuple[bytes, List[float]]]):
+        try:
+            self.store.put_many(namespace, items)
+        except sqlite3.Error as e:
+            logger.warning("Embedding cache write failed: %s", e)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        namespace = f"{self.model_name}:document"
+        hashes = [text_hash(text) for text in texts]
+        found = self._lookup(namespace, hashes)
+        misses: Dict[bytes, str] = {}
+        for key, text in zip(hashes, texts):
+            if key not in found:
+                misses.setdefault(key, text)
+        missed = sum(1 for key in hashes if key not in found)
+        LOOKUPS.inc(len(texts) - missed, kind="document", result="hit")
+        LOOKUPS.inc(missed, kind="document", result="miss")
+        if misses:
+            vectors = self.underlying.embed_documents(list(misses.values()))
+            new = list(zip(misses.keys(), vectors))
+            self._save(namespace, new)
+            found.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in new)
+        return [found[key].tolist() for key in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        namespace = f"{self.model_name}:query"
+        key = text_hash(text)
+        found = self._lookup(namespace, [key])
+        if key in found:
+            LOOKUPS.inc(kind="query", result="hit")
+            return found[key].tolist()
+        LOOKUPS.inc(kind="query", result="miss")
+        vector = self.underlying.embed_query(text)
+        self._save(namespace, [(key, vector)])
+        return vector
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_embedding_store() -> EmbeddingStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EmbeddingStore()
+    return _store
+
+# Wrap an embedding model with the shared on-disk cache, unless EMBEDDING_CACHE=0
+def with_embedding_cache(embeddings: Embeddings, model_name: str) -> Embeddings:
+    if not EMBEDDING_CACHE:
+        return embeddings
+    try:
+        return CachedEmbeddings(embeddings, model_name, get_embedding_store())
+    except sqlite3.Error as e:
+        logger.warning("Embedding cache at %s unavailable, embedding without it: %s", EMBEDDING_CACHE_PATH, e)
+        return embeddings
+
+
+def main(argv=None) -> int:
+    command = (argv if argv is not None else sys.argv[1:] or ["stats"])[0]
+    store = EmbeddingStore()
+    if command == "stats":
+        size = os.path.getsize(store.path) if os.path.exists(store.path) else 0
+        print(f"{len(store)} vectors (cap {store.max_entries}), {size / 1e6:.1f} MB in {store.path}")
+    elif command == "clear":
+        store.clear()
+        print("Embedding cache cleared")
+    else:
+        print(f"Unknown command: {command}, expected stats or clear")
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
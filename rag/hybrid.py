@@ -0,0 +1,170 @@
+"""Hybrid retrieval: exact metadata matches on university and country names, fused with vector search.
+
+The ranking index recognizes the university or country a question is about. The university's
+documents are then fetched with an indexed exact match on `university_key` (the normalized name
+written by rag.ingest), falling back to a prefix match. How that combines with the vector search:
+- a confident university match with documents is answered from those documents alone, without
+  embedding the question or running the vector search;
+- a weaker university candidate is fetched the same way and fused with the vector results by
+  reciprocal rank fusion;
+- a country (and no university) pre-filters the vector search to that country.
+
+The country pre-filter needs `country` declared as a filter field of the Atlas vector index, which
+`ensure_vector_search_index` (run by rag.ingest) adds. Against an index without it, the first
+filtered search fails; the retriever then logs it once and searches without the filter.
+"""
+import os
+import re
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import dotenv
+from pymongo.errors import OperationFailure
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from metrics import Counter, STAGE_LATENCY
+from rag.ranking_index import RankingIndex
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Hybrid retrieval configuration
+RAG_HYBRID = os.getenv("RAG_HYBRID", "1") == "1"  # Set to 0 for plain vector search
+RAG_LEXICAL_MIN_SCORE = float(os.getenv("RAG_LEXICAL_MIN_SCORE", "0.75"))  # Ranking index match score to use a candidate
+RRF_K = 60  # The usual reciprocal rank fusion constant, damps the weight of the top ranks
+
+KEY_FIELD = "university_key"
+COUNTRY_FIELD = "country"
+
+ROUTES = Counter("elyuf_hybrid_routes_total", "How hybrid retrieval answered a question", ["route"])
+
+
+def ensure_metadata_indexes(collection):
+    """Create the indexes the exact and prefix matches rely on. Safe to call on every ingest."""
+    collection.create_index(KEY_FIELD)
+    collection.create_index(COUNTRY_FIELD)
+
+
+def ensure_vector_search_index(collection, name: str, dimensions: int = 768):
+    """Declare the filter fields the pre-filtered vector search relies on in the Atlas vector index.
+
+    An existing index keeps its vector field and gets the missing filter fields; a missing one is
+    created with cosine similarity. Atlas builds the index in the background."""
+    from pymongo.operations import SearchIndexModel
+
+    filters = [{"type": "filter", "path": COUNTRY_FIELD}, {"type": "filter", "path": KEY_FIELD}]
+    existing = next(iter(collection.list_search_indexes(name)), None)
+    if existing is None:
+        definition = {"fields": [{"type": "vector", "path": "embedding", "numDimensions": dimensions,
+                                  "similarity": "cosine"}] + filters}
+        collection.create_search_index(SearchIndexModel(definition, name=name, type="vectorSearch"))
+        logger.info("Created the vector search index %s", name)
+        return
+    fields = list(existing.get("latestDefinition", {}).get("fields", []))
+    declared = {field.get("path") for field in fields if field.get("type") == "filter"}
+    missing = [field for field in filters if field["path"] not in declared]
+    if missing:
+        collection.update_search_index(name, {"fields": fields + missing})
+        logger.info("Added the filter fields %s to the vector search index %s", [field["path"] for field in missing], name)
+
+
+class MongoLexicalSearch:
+    """Exact and prefix matches on a metadata field of the vector collection."""
+
+    def __init__(self, get_collection: Callable[[], Any]):
+        self._get_collection = get_collection
+
+    def find(self, field: str, values: Sequence[str], limit: int = 10, prefix: bool = False) -> List[Document]:
+        if prefix:
+            # An anchored, case-sensitive regex is answered from the index on the field
+            condition = {"$or": [{field: {"$regex": f"^{re.escape(value)}"}} for value in values]}
+        else:
+            condition = {field: {"$in": list(values)}}
+        documents = []
+        for doc in self._get_collection().find(condition, {"embedding": 0, "content_hash": 0}).limit(limit):
+            text = doc.pop("text", "")
+            doc["_id"] = str(doc["_id"])
+            # An exact metadata match is as strong as retrieval evidence gets
+            documents.append(Document(page_content=text, metadata={**doc, "score": 1.0}))
+        return documents
+
+
+def _doc_id(doc: Document) -> str:
+    return str(doc.metadata.get("_id") or doc.page_content)
+
+
+def reciprocal_rank_fusion(result_lists: Sequence[List[Document]], k: int = RRF_K) -> List[Document]:
+    """Merge ranked lists by the sum of 1 / (k + rank) over the lists each document appears in."""
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = _doc_id(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, doc)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Combines exact university/country matches with vector search, see the module docstring.
+
+    `vector_search(query, k, pre_filter)` runs the vector search of the configured backend, and
+    `lexical` is a MongoLexicalSearch or a LocalVectorIndex."""
+
+    ranking_index: Callable[[], RankingIndex]
+    lexical: Any
+    vector_search: Callable[[str, int, Optional[dict]], List[Document]]
+    k: int = 4
+    short_circuit: bool = True
+    min_score: float = RAG_LEXICAL_MIN_SCORE
+    # Turned off for the process when the vector index doesn't declare the country filter field
+    country_filter: bool = True
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _lexical(self, record) -> List[Document]:
+        with STAGE_LATENCY.time(stage="lexical_search"):
+            documents = self.lexical.find(KEY_FIELD, [record.key] + record.aliases, limit=self.k)
+            if not documents:
+                # Short aliases like "mit" would prefix-match unrelated names, so only the full name is tried
+                documents = self.lexical.find(KEY_FIELD, [record.key], limit=self.k, prefix=True)
+        return documents
+
+    def _vector(self, query: str, pre_filter: Optional[dict]) -> List[Document]:
+        with STAGE_LATENCY.time(stage="vector_search"):
+            return self.vector_search(query, self.k, pre_filter)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        index = self.ranking_index()
+        match = index.lookup(query)
+        lexical_docs: List[Document] = []
+        if match is not None and match.score >= self.min_score:
+            lexical_docs = self._lexical(match.record)
+            if lexical_docs and match.confident and self.short_circuit:
+                ROUTES.inc(route="exact")
+                return lexical_docs
+
+        countries = index.mentioned_countries(query) if not lexical_docs and self.country_filter else []
+        if countries:
+            try:
+                vector_docs = self._vector(query, {COUNTRY_FIELD: {"$in": countries}})
+            except OperationFailure as e:
+                logger.warning("Country pre-filter failed, searching without it until restart "
+                               "(run python -m rag.ingest to add the filter field to the vector index): %s", e)
+                self.country_filter = False
+                vector_docs = []
+            if vector_docs:
+                ROUTES.inc(route="country")
+                return vector_docs
+
+        vector_docs = self._vector(query, None)
+        if not lexical_docs:
+            ROUTES.inc(route="vector")
+            return vector_docs
+        ROUTES.inc(route="fused")
+        return reciprocal_rank_fusion([lexical_docs, vector_docs])[:self.k]
@@ -0,0 +1,243 @@
+"""Incremental ingestion of the ranking JSON files into the Atlas vector collection.
+
+Every ranking row becomes one document with a stable `_id` derived from its source and university,
+and a `content_hash` of what gets embedded. With `--mode university` the sources are merged instead,
+into one document per university holding all of its ranks, with names matched across sources the
+way the bot's ranking index matches them. A run only embeds documents that are new or whose hash changed,
+upserts them in batches with several embedding requests in flight, and deletes documents whose row
+disappeared from the JSON files. Completed batches are recorded in a checkpoint file, so an
+interrupted run resumes where it stopped.
+
+Usage: python -m rag.ingest [--mode row|university] [--data-dir DIR] [--batch-size N] [--workers N] [--no-prune] [--dry-run]
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+import dotenv
+from pymongo.errors import OperationFailure
+
+from rag.answer_cache import bump_embeddings_version
+from rag.hybrid import ensure_metadata_indexes, ensure_vector_search_index
+from rag.mongodb_database import INDEX_NAME
+from rag.ranking_index import normalize_name
+from ranking_snapshot import directory_sources, load_snapshot
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Ingestion configuration
+INGEST_DATA_DIR = os.getenv("INGEST_DATA_DIR", os.path.join(REPO_ROOT, "data", "json_data"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))  # Texts per embedding request
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))  # Embedding requests in flight
+INGEST_CHECKPOINT = os.getenv("INGEST_CHECKPOINT", os.path.join(REPO_ROOT, "rag", ".ingest-checkpoint.json"))
+INGEST_MODE = os.getenv("INGEST_MODE", "row")  # "row": a document per source row, "university": a document per university
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "1000"))  # University documents longer than this are split
+EMBEDDING_MODEL = "text-embedding-004"
+
+
+@dataclass
+class IngestRecord:
+    doc_id: str
+    text: str
+    metadata: dict
+    content_hash: str
+
+    def to_document(self, embedding: List[float]) -> dict:
+        # Same shape MongoDBAtlasVectorSearch writes: text, embedding and the metadata at the top level
+        return {"_id": self.doc_id, "text": self.text, "embedding": embedding, **self.metadata,
+                "content_hash": self.content_hash}
+
+
+def _hash(*parts) -> str:
+    return hashlib.sha256("\x1f".join(json.dumps(part, sort_keys=True) for part in parts).encode()).hexdigest()
+
+
+def load_data_snapshot(data_dir: str):
+    """The compiled snapshot of every JSON ranking file in data_dir, rebuilt if a file changed."""
+    return load_snapshot(directory_sources(data_dir), os.path.join(data_dir, "rankings.snapshot"))
+
+
+def read_sources(data_dir: str) -> List[Tuple[str, list]]:
+    """(source, items) for every JSON ranking file in data_dir."""
+    sources = []
+    snapshot = load_data_snapshot(data_dir)
+    for position, info in enumerate(snapshot.header["sources"]):
+        if not info["rows"]:
+            logger.warning("No rows in %s, skipping it", info["file"])
+            continue
+        sources.append((info["name"], snapshot.items(position)))
+        logger.info("Loaded %s (source: %s)", info["file"], info["name"])
+    return sources
+
+
+def load_records(data_dir: str) -> List[IngestRecord]:
+    """Read every JSON file in data_dir into one record per ranking row."""
+    records: Dict[str, IngestRecord] = {}
+    for source, items in read_sources(data_dir):
+        for item in items:
+            try:
+                text = f" Source: {source}, Rank: {item['rank']}, University: {item['university']}, Country: {item['country']}"
+            except KeyError as e:
+                logger.warning("Skipping item of %s with missing key %s: %s", source, e, item)
+                continue
+            metadata = {
+                "source": item.get("source", source),
+                "rank": item.get("rank"),
+                "university": item.get("university"),
+                "country": item.get("country"),
+                # Indexed for exact-name matching in hybrid retrieval
+                "university_key": normalize_name(item["university"]),
+            }
+            # Stable across runs, so a changed rank replaces its document instead of adding a new one
+            doc_id = hashlib.sha1(f"{source}|{normalize_name(item['university'])}".encode()).hexdigest()
+            records[doc_id] = IngestRecord(doc_id, text, metadata, _hash(EMBEDDING_MODEL, text, metadata))
+    return list(records.values())
+
+
+def load_university_records(data_dir: str, chunk_size: int = INGEST_CHUNK_SIZE) -> List[IngestRecord]:
+    """Read every JSON file in data_dir into one record per university, with its rank in every source.
+
+    A university's text is a single line, so it is embedded whole; only a text longer than
+    `chunk_size` is split, into chunks that each repeat the university's name."""
+    snapshot = load_data_snapshot(data_dir)
+    sources = [info["name"] for info in snapshot.header["sources"] if info["rows"]]
+    records: List[IngestRecord] = []
+    # The snapshot holds the universities already merged across sources
+    for university in snapshot.records():
+        ranks = ", ".join(f"{source} Rank: {university.ranks.get(source, 'not ranked')}" for source in sources)
+        text = f" University: {university.name}, Country: {university.country}, {ranks}"
+        metadata = {
+            "university": university.name,
+            "country": university.country,
+            "university_key": university.key,
+            "ranks": dict(university.ranks),
+        }
+        # Stable across runs and distinct from the per-row ids, so switching modes replaces the documents
+        doc_id = hashlib.sha1(f"university|{university.key}".encode()).hexdigest()
+        if len(text) <= chunk_size:
+            records.append(IngestRecord(doc_id, text, metadata, _hash(EMBEDDING_MODEL, text, metadata)))
+            continue
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0, separators=[", ", " "])
+        for n, chunk in enumerate(splitter.split_text(text)):
+            chunk_text = chunk if n == 0 else f" University: {university.name}, {chunk.lstrip(', ')}"
+            chunk_metadata = {**metadata, "chunk": n}
+            records.append(IngestRecord(f"{doc_id}-{n}", chunk_text, chunk_metadata,
+                                        _hash(EMBEDDING_MODEL, chunk_text, chunk_metadata)))
+    logger.info("Merged %d sources into %d university documents", len(sources), len(records))
+    return records
+
+
+def _load_checkpoint(path: str) -> Dict[str, str]:
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_checkpoint(path: str, done: Dict[str, str]):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as checkpoint:
+        json.dump(done, checkpoint)
+    os.replace(tmp_path, path)
+
+
+def _embed_and_upsert(collection, embeddings, batch: List[IngestRecord]) -> List[IngestRecord]:
+    from pymongo import ReplaceOne
+
+    vectors = embeddings.embed_documents([record.text for record in batch])
+    collection.bulk_write(
+        [ReplaceOne({"_id": record.doc_id}, record.to_document(vector), upsert=True)
+         for record, vector in zip(batch, vectors)],
+        ordered=False,
+    )
+    return batch
+
+
+def ingest(collection, embeddings, records: List[IngestRecord], batch_size: int = INGEST_BATCH_SIZE,
+           workers: int = INGEST_WORKERS, checkpoint_path: str = INGEST_CHECKPOINT, prune: bool = True,
+           dry_run: bool = False) -> dict:
+    """Embed and upsert new or changed records, delete stale ones, and return a summary."""
+    existing = {doc["_id"]: doc.get("content_hash") for doc in collection.find({}, {"_id": 1, "content_hash": 1})}
+    done = _load_checkpoint(checkpoint_path)
+    pending = [record for record in records
+               if existing.get(record.doc_id) != record.content_hash and done.get(record.doc_id) != record.content_hash]
+    current_ids = {record.doc_id for record in records}
+    stale_ids = [doc_id for doc_id in existing if doc_id not in current_ids] if prune else []
+    summary = {"records": len(records), "unchanged": len(records) - len(pending), "embedded": 0,
+               "deleted": 0, "resumed": len(done)}
+    logger.info("%d records, %d to embed, %d stale", len(records), len(pending), len(stale_ids))
+    if dry_run:
+        summary.update(to_embed=len(pending), to_delete=len(stale_ids))
+        return summary
+
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_embed_and_upsert, collection, embeddings, batch) for batch in batches]
+        for future in as_completed(futures):
+            batch = future.result()
+            done.update((record.doc_id, record.content_hash) for record in batch)
+            _save_checkpoint(checkpoint_path, done)
+            summary["embedded"] += len(batch)
+            logger.info("Embedded %d/%d records", summary["embedded"], len(pending))
+
+    if stale_ids:
+        summary["deleted"] = collection.delete_many({"_id": {"$in": stale_ids}}).deleted_count
+    ensure_metadata_indexes(collection)
+    try:
+        if INDEX_NAME:
+            ensure_vector_search_index(collection, INDEX_NAME)
+    except OperationFailure as e:
+        # e.g. on deployments where search indexes can't be managed through the driver
+        logger.warning("Could not update the vector search index, add the filter fields in Atlas: %s", e)
+    # The run finished, the next one starts from the content hashes in the collection
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if summary["embedded"] or summary["deleted"]:
+        bump_embeddings_version()
+    return summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Embed the ranking JSON files into the Atlas vector collection.")
+    parser.add_argument("--mode", choices=("row", "university"), default=INGEST_MODE,
+                        help="One document per source row, or one per university with all its ranks")
+    parser.add_argument("--data-dir", default=INGEST_DATA_DIR, help="Directory with the ranking JSON files")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Texts per embedding request")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Embedding requests in flight")
+    parser.add_argument("--checkpoint", default=INGEST_CHECKPOINT, help="Checkpoint file for resuming a run")
+    parser.add_argument("--no-prune", action="store_true", help="Keep documents whose row is gone from the files")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be embedded and deleted")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    # Authenticate Google Cloud service account
+    os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "rag/google-services/eyuf-rag-427520-319f41429e2b.json")
+
+    from langchain_google_vertexai import VertexAIEmbeddings
+    from rag.mongodb_database import get_collection
+    from rag.embedding_cache import with_embedding_cache
+
+    records = load_university_records(args.data_dir) if args.mode == "university" else load_records(args.data_dir)
+    # Rows embedded by an earlier run, even one whose checkpoint or collection is gone, come from the local cache
+    embeddings = with_embedding_cache(VertexAIEmbeddings(model_name=EMBEDDING_MODEL), EMBEDDING_MODEL)
+    summary = ingest(get_collection(), embeddings, records, batch_size=args.batch_size, workers=args.workers,
+                     checkpoint_path=args.checkpoint, prune=not args.no_prune, dry_run=args.dry_run)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import time
+import logging
+import threading
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from metrics import STAGE_LATENCY, LLM_CALLS, LLM_CALLS_PER_REQUEST, LLM_TOKENS
+from logging_pipeline import log_event
+
+logger = logging.getLogger(__name__)
+
+
+def _token_usage(response) -> Dict[str, int]:
+    """Input/output token counts of an LLM result, from the message metadata or the provider output."""
+    usage = {"input": 0, "output": 0}
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                usage["input"] += metadata.get("input_tokens", 0)
+                usage["output"] += metadata.get("output_tokens", 0)
+    if not any(usage.values()):
+        # Vertex reports usage in its own format in llm_output
+        metadata = (response.llm_output or {}).get("usage_metadata") or {}
+        usage["input"] = metadata.get("prompt_token_count", 0)
+        usage["output"] = metadata.get("candidates_token_count", 0)
+    return usage
+
+
+class StageTimingCallback(BaseCallbackHandler):
+    """Times the stages of one run of the RAG chain and counts its LLM calls and tokens.
+
+    Stages are told apart by where a run sits in the chain: a retriever nested in another retriever is
+    the base retrieval under the compression retriever, an LLM call under a retriever is a
+    compression call (LLMChainExtractor), and any other LLM call is the final generation. Create one
+    handler per request and call `finish` when the run is done."""
+
+    # Metric updates are cheap, run them on the event loop rather than in an executor
+    run_inline = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._kinds: Dict[UUID, str] = {}
+        self._started: Dict[UUID, float] = {}
+        self._stages: Dict[UUID, str] = {}
+        self._first_token: set = set()
+        self.llm_calls = 0
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], kind: str):
+        with self._lock:
+            self._parents[run_id] = parent_run_id
+            self._kinds[run_id] = kind
+            self._started[run_id] = time.perf_counter()
+
+    def _end(self, run_id: UUID) -> Optional[float]:
+        with self._lock:
+            started = self._started.pop(run_id, None)
+        return None if started is None else time.perf_counter() - started
+
+    def _under_retriever(self, parent_run_id: Optional[UUID]) -> bool:
+        while parent_run_id is not None:
+            if self._kinds.get(parent_run_id) == "retriever":
+                return True
+            parent_run_id = self._parents.get(parent_run_id)
+        return False
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._start(run_id, parent_run_id, "chain")
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._stages[run_id] = "base_retrieval" if self._under_retriever(parent_run_id) else "retrieval"
+        self._start(run_id, parent_run_id, "retriever")
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any):
+        elapsed = self._end(run_id)
+        if elapsed is not None:
+            stage = self._stages.pop(run_id)
+            STAGE_LATENCY.observe(elapsed, stage=stage)
+            log_event(logger, "rag_stage", stage=stage, seconds=round(elapsed, 4), documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._observe_failed(run_id, type(error).__name__)
+
+    def _llm_start(self, run_id: UUID, parent_run_id: Optional[UUID]):
+        stage = "compression" if self._under_retriever(parent_run_id) else "generation"
+        self._stages[run_id] = stage
+        self._start(run_id, parent_run_id, "llm")
+        LLM_CALLS.inc(stage=stage)
+        self.llm_calls += 1
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._llm_start(run_id, parent_run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._llm_start(run_id, parent_run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        # Time to the first streamed token is what the user waits for before the reply starts moving
+        if run_id not in self._first_token and run_id in self._started:
+            self._first_token.add(run_id)
+            STAGE_LATENCY.observe(time.perf_counter() - self._started[run_id],
+                                  stage=f"{self._stages[run_id]}_first_token")
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        elapsed = self._end(run_id)
+        stage = self._stages.pop(run_id, "generation")
+        self._first_token.discard(run_id)
+        usage = _token_usage(response)
+        if elapsed is not None:
+            STAGE_LATENCY.observe(elapsed, stage=stage)
+            log_event(logger, "rag_stage", stage=stage, seconds=round(elapsed, 4),
+                      input_tokens=usage["input"], output_tokens=usage["output"])
+        for kind, count in usage.items():
+            if count:
+                LLM_TOKENS.inc(count, kind=kind)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._first_token.discard(run_id)
+        self._observe_failed(run_id, type(error).__name__)
+
+    def _observe_failed(self, run_id: UUID, error: str):
+        # Failed stages are timed too, slow failures are the ones worth seeing
+        elapsed = self._end(run_id)
+        stage = self._stages.pop(run_id, None)
+        if elapsed is not None and stage is not None:
+            STAGE_LATENCY.observe(elapsed, stage=stage)
+            log_event(logger, "rag_stage", stage=stage, seconds=round(elapsed, 4), error=error)
+
+    def finish(self):
+        """Record the run. Called when the chain returns, raises or is cancelled, e.g. by the timeout."""
+        # A cancelled chain gets no end or error callbacks, its open stages end here
+        for run_id in list(self._stages):
+            self._observe_failed(run_id, "cancelled")
+        LLM_CALLS_PER_REQUEST.observe(self.llm_calls)
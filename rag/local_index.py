@@ -0,0 +1,202 @@
+"""Local vector index, an alternative to querying Atlas Vector Search on every question.
+
+`export` copies the `embedding`, `text` and metadata fields of the vector collection into a float32
+matrix (`<prefix>.npy`, rows L2-normalized) and a JSON sidecar (`<prefix>.json`). At query time the
+matrix is memory-mapped and top-k cosine similarity is a single matrix-vector product.
+
+Usage: python -m rag.local_index export [--out PREFIX]
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import dotenv
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", os.path.join(REPO_ROOT, "rag", "index", "rankings"))
+
+TEXT_KEY = "text"
+EMBEDDING_KEY = "embedding"
+
+
+def export_index(collection, prefix: str = LOCAL_INDEX_PATH) -> int:
+    """Write every document of the vector collection to `<prefix>.npy` and `<prefix>.json`.
+
+    Raises ValueError when no document has an embedding; the existing index is left in place."""
+    vectors, entries = [], []
+    for doc in collection.find({EMBEDDING_KEY: {"$exists": True}}):
+        vectors.append(doc.pop(EMBEDDING_KEY))
+        text = doc.pop(TEXT_KEY, "")
+        doc["_id"] = str(doc["_id"])
+        doc.pop("content_hash", None)
+        entries.append({"text": text, "metadata": doc})
+    if not vectors:
+        # An empty index would make every retrieval come back empty, and it has no embedding dimension
+        raise ValueError("No documents with embeddings in the vector collection, run the ingestion first")
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms == 0, 1, norms)
+
+    os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+    # Write to temporary files first, so a running bot never maps a half-written index
+    np.save(f"{prefix}.tmp.npy", matrix)
+    with open(f"{prefix}.tmp.json", "w", encoding="utf-8") as sidecar:
+        json.dump(entries, sidecar, ensure_ascii=False)
+    os.replace(f"{prefix}.tmp.npy", f"{prefix}.npy")
+    os.replace(f"{prefix}.tmp.json", f"{prefix}.json")
+    return len(entries)
+
+
+def _matches(metadata: dict, condition: Dict[str, Any]) -> bool:
+    for field, expected in condition.items():
+        value = metadata.get(field)
+        if isinstance(expected, dict):
+            if "$in" in expected and value not in expected["$in"]:
+                return False
+            if "$eq" in expected and value != expected["$eq"]:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+class LocalVectorIndex:
+    """Memory-mapped float32 matrix of normalized embeddings plus their texts and metadata."""
+
+    def __init__(self, matrix: np.ndarray, entries: List[dict]):
+        if len(matrix) != len(entries):
+            raise ValueError(f"Index matrix has {len(matrix)} rows but the sidecar has {len(entries)} entries")
+        self.matrix = matrix
+        self.entries = entries
+        # Per-field value -> rows maps for exact metadata lookups, built on first use
+        self._field_index: Dict[str, Dict[Any, List[int]]] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, prefix: str = LOCAL_INDEX_PATH) -> "LocalVectorIndex":
+        matrix = np.load(f"{prefix}.npy", mmap_mode="r")
+        with open(f"{prefix}.json", encoding="utf-8") as sidecar:
+            entries = json.load(sidecar)
+        logger.info("Loaded local vector index with %d documents from %s", len(entries), prefix)
+        return cls(matrix, entries)
+
+    def mask(self, condition: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Boolean row mask for an equality/`$in` metadata filter, None when there is no filter."""
+        if not condition:
+            return None
+        return np.fromiter((_matches(entry["metadata"], condition) for entry in self.entries), bool, len(self.entries))
+
+    def search(self, vector, k: int = 4, condition: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        """Top-k rows by cosine similarity, as (row, similarity) pairs, best first."""
+        if not len(self.entries):
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self.matrix @ query
+        mask = self.mask(condition)
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top if np.isfinite(scores[row])]
+
+    def _rows_by_value(self, field: str) -> Dict[Any, List[int]]:
+        index = self._field_index.get(field)
+        if index is None:
+            index = defaultdict(list)
+            for row, entry in enumerate(self.entries):
+                index[entry["metadata"].get(field)].append(row)
+            self._field_index[field] = index = dict(index)
+        return index
+
+    def find(self, field: str, values: Sequence[Any], limit: int = 10, prefix: bool = False) -> List[Document]:
+        """Documents whose metadata `field` equals one of `values`, or starts with one with `prefix`.
+
+        Same contract as `hybrid.MongoLexicalSearch.find`, served from an in-memory field index."""
+        index = self._rows_by_value(field)
+        if prefix:
+            keys = sorted(key for key in index if isinstance(key, str))
+            matched = []
+            for value in values:
+                start = bisect_left(keys, value)
+                while start < len(keys) and keys[start].startswith(value):
+                    matched.append(keys[start])
+                    start += 1
+        else:
+            matched = [value for value in values if value in index]
+        rows = sorted({row for value in matched for row in index[value]})[:limit]
+        # An exact metadata match is as strong as retrieval evidence gets
+        return [self.document(row, 1.0) for row in rows]
+
+    def similarity_search(self, embeddings: Embeddings, query: str, k: int = 4,
+                          condition: Optional[Dict[str, Any]] = None) -> List[Document]:
+        vector = embeddings.embed_query(query)
+        return [self.document(row, score) for row, score in self.search(vector, k, condition)]
+
+    def document(self, row: int, similarity: float) -> Document:
+        entry = self.entries[row]
+        # Same 0..1 scale as Atlas' cosine vectorSearchScore, so score thresholds work with either backend
+        metadata = {**entry["metadata"], "score": (1.0 + similarity) / 2.0}
+        return Document(page_content=entry["text"], metadata=metadata)
+
+    def as_retriever(self, embeddings: Embeddings, search_kwargs: Optional[dict] = None) -> "LocalVectorRetriever":
+        search_kwargs = search_kwargs or {}
+        return LocalVectorRetriever(
+            index=self, embeddings=embeddings, k=search_kwargs.get("k", 4), pre_filter=search_kwargs.get("pre_filter")
+        )
+
+
+class LocalVectorRetriever(BaseRetriever):
+    """Drop-in for `MongoDBAtlasVectorSearch.as_retriever()` backed by a LocalVectorIndex."""
+
+    index: LocalVectorIndex
+    embeddings: Embeddings
+    k: int = 4
+    pre_filter: Optional[Dict[str, Any]] = None
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.index.similarity_search(self.embeddings, query, self.k, self.pre_filter)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Local vector index for the ranking documents.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export the Atlas vector collection to a local index")
+    export_parser.add_argument("--out", default=LOCAL_INDEX_PATH, help="Path prefix for the .npy and .json files")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    if args.command == "export":
+        from rag.mongodb_database import get_collection
+        try:
+            count = export_index(get_collection(), args.out)
+        except ValueError as e:
+            logger.error("Export failed: %s", e)
+            return 1
+        print(f"Exported {count} documents to {args.out}.npy and {args.out}.json")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import os
+import threading
 import certifi
 from pymongo import MongoClient
 import dotenv
@@ -12,16 +13,51 @@ DATABASE_NAME = os.getenv("DATABASE_NAME")
 COLLECTION_NAME = os.getenv("COLLECTION_NAME")
 INDEX_NAME = os.getenv("INDEX_NAME")
 
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_OP_TIMEOUT = float(os.getenv("MONGO_OP_TIMEOUT", "5"))  # Seconds before a single database operation from the bot gives up
+
 # MongoDB connection
-ca_cert_path = certifi.where()
-client = MongoClient(MONGODB_URI, tlsCAFile=ca_cert_path)
-db = client[DATABASE_NAME]
-collection = db[COLLECTION_NAME]
-
-# Print Existing database_names
-for db_name in client.list_database_names():
-    print(db_name)
-    
+# A single pooled client is shared by the RAG collection and the users collection (user_database.py).
+# It is created on first use, so importing this module doesn't connect to anything.
+_client_lock = threading.Lock()
+_client = None
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MongoClient(MONGODB_URI, tlsCAFile=certifi.where(), maxPoolSize=MONGO_MAX_POOL_SIZE)
+    return _client
+
+# Asyncio-native client (motor) for the bot's handlers, with its own connection pool.
+# Created on first use from the running event loop and bound to it.
+_async_client = None
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        _async_client = AsyncIOMotorClient(
+            MONGODB_URI,
+            tlsCAFile=certifi.where(),
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            serverSelectionTimeoutMS=int(MONGO_OP_TIMEOUT * 1000),
+        )
+    return _async_client
+
+def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        _async_client.close()
+        _async_client = None
+
+def get_db():
+    return get_client()[DATABASE_NAME]
+
+def get_collection():
+    return get_db()[COLLECTION_NAME]
+
 # count = collection.count_documents({})
 # print(f"Number of documents in the collection: {count}")
 
@@ -39,6 +75,8 @@ if __name__ == "__main__":
 
 
 # For Atlas Cluster Vector Search Configurations
+# The filter fields let hybrid retrieval (rag/hybrid.py) pre-filter the vector search by country or university.
+# rag.ingest adds them to the index named INDEX_NAME (rag.hybrid.ensure_vector_search_index).
 #     """
 #     {
 #   "fields": [
@@ -47,7 +85,9 @@ if __name__ == "__main__":
 #       "path": "embedding",
 #       "numDimensions": 768,
 #       "similarity": "cosine" or "euclidean" 
-#     }
+#     },
+#     { "type": "filter", "path": "country" },
+#     { "type": "filter", "path": "university_key" }
 #   ]
 # }
 #     """
\ No newline at end of file
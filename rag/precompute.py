@@ -0,0 +1,197 @@
+"""Precomputed answers for every university of the ranking snapshot.
+
+The job asks the RAG chain about each university, `PRECOMPUTE_WORKERS` at a time, and stores the
+answers keyed by the university's normalized name. Each answer records a hash of the university's
+row in the snapshot (name, country and ranks) together with the system prompt and model it was
+generated with. A run only regenerates answers whose hash changed or that are missing, and drops
+universities that left the rankings. The bot serves an answer only while its hash still matches
+the loaded snapshot, so a changed rank falls back to the ranking index until the job ran again.
+
+Usage: python -m rag.precompute [--workers N] [--limit N] [--force] [--dry-run]
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from typing import Dict, Iterable, List, Optional
+
+import dotenv
+
+from metrics import Counter
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Precomputed answers configuration
+PRECOMPUTED_ANSWERS = os.getenv("PRECOMPUTED_ANSWERS", "1") == "1"  # Set to 0 to always format answers from the index
+PRECOMPUTED_ANSWERS_PATH = os.getenv("PRECOMPUTED_ANSWERS_PATH", os.path.join(REPO_ROOT, "data", "precomputed-answers.json"))
+PRECOMPUTE_WORKERS = int(os.getenv("PRECOMPUTE_WORKERS", "4"))  # RAG chain runs in flight during the job
+PRECOMPUTE_QUESTION = "What are the rankings of {name}?"
+TABLE_VERSION = 1
+RELOAD_INTERVAL = 10.0  # Seconds between checks for a rebuilt table
+
+SERVED = Counter("elyuf_precomputed_answers_total", "Ranking index matches, by whether a precomputed answer was served", ["result"])
+
+
+def generation_version() -> str:
+    """Hash of what shapes an answer besides the data: the system prompt, the model and the question."""
+    from rag.query_util import system_prompt, LLM_MODEL
+    return hashlib.sha256("\x1f".join((system_prompt, LLM_MODEL, PRECOMPUTE_QUESTION)).encode()).hexdigest()[:16]
+
+
+def row_hash(record, version: str) -> str:
+    row = {"name": record.name, "country": record.country, "ranks": record.ranks, "version": version}
+    return hashlib.sha256(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def load_table(path: str = PRECOMPUTED_ANSWERS_PATH) -> dict:
+    try:
+        with open(path, encoding="utf-8") as table_file:
+            table = json.load(table_file)
+    except (OSError, json.JSONDecodeError):
+        return {"version": TABLE_VERSION, "answers": {}}
+    if table.get("version") != TABLE_VERSION:
+        return {"version": TABLE_VERSION, "answers": {}}
+    return table
+
+
+def save_table(table: dict, path: str = PRECOMPUTED_ANSWERS_PATH):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as table_file:
+        json.dump(table, table_file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+async def precompute(records, ask, table: dict, workers: int = PRECOMPUTE_WORKERS, force: bool = False,
+                     dry_run: bool = False, save=None, version: Optional[str] = None,
+                     ranked_keys: Optional[Iterable[str]] = None) -> dict:
+    """Generate the missing and outdated answers of `table` for `records` with `ask(question)`.
+
+    Answers of universities missing from `ranked_keys`, every key of the snapshot, are removed; it
+    defaults to the keys of `records`, so pass it when `records` is only part of the snapshot.
+    `save(table)` is called after every answer, so an interrupted run keeps what it generated."""
+    version = version if version is not None else generation_version()
+    answers: Dict[str, dict] = table.setdefault("answers", {})
+    ranked = set(ranked_keys) if ranked_keys is not None else {record.key for record in records}
+    stale = [key for key in answers if key not in ranked]
+    pending = [record for record in records
+               if force or answers.get(record.key, {}).get("row_hash") != row_hash(record, version)]
+    summary = {"universities": len(records), "unchanged": len(records) - len(pending), "generated": 0,
+               "failed": 0, "removed": len(stale)}
+    logger.info("%d universities, %d answers to generate, %d to remove", len(records), len(pending), len(stale))
+    if dry_run:
+        summary["to_generate"] = len(pending)
+        return summary
+
+    for key in stale:
+        del answers[key]
+    semaphore = asyncio.Semaphore(workers)
+
+    async def generate(record):
+        async with semaphore:
+            try:
+                answer = await ask(PRECOMPUTE_QUESTION.format(name=record.name))
+            except Exception as e:
+                logger.warning("Could not generate the answer for %s: %s", record.name, e)
+                summary["failed"] += 1
+                return
+        if not answer or not answer.strip():
+            summary["failed"] += 1
+            return
+        answers[record.key] = {"name": record.name, "answer": answer, "row_hash": row_hash(record, version),
+                               "generated_at": time.time()}
+        summary["generated"] += 1
+        if save is not None:
+            save(table)
+        logger.info("Generated %d/%d answers", summary["generated"], len(pending))
+
+    await asyncio.gather(*(generate(record) for record in pending))
+    table["generation_version"] = version
+    if save is not None:
+        save(table)
+    return summary
+
+
+class PrecomputedAnswers:
+    """The answer table as the bot serves it: only answers whose row hash matches the snapshot."""
+
+    def __init__(self, path: str = PRECOMPUTED_ANSWERS_PATH):
+        self.path = path
+        self._answers: Dict[str, str] = {}
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+
+    def _reload(self):
+        from rag.ranking_index import get_ranking_index
+
+        version = generation_version()
+        entries = load_table(self.path)["answers"]
+        self._answers = {
+            record.key: entries[record.key]["answer"] for record in get_ranking_index().records
+            if record.key in entries and entries[record.key].get("row_hash") == row_hash(record, version)
+        }
+        logger.info("Loaded %d precomputed answers (%d outdated)", len(self._answers), len(entries) - len(self._answers))
+
+    def _check(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = 0.0
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._reload() if mtime else self._answers.clear()
+
+    def get(self, record) -> Optional[str]:
+        if not PRECOMPUTED_ANSWERS:
+            return None
+        self._check()
+        answer = self._answers.get(record.key)
+        SERVED.inc(result="hit" if answer is not None else "miss")
+        return answer
+
+    def __len__(self) -> int:
+        return len(self._answers)
+
+
+precomputed_answers = PrecomputedAnswers()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Precompute the RAG answer for every university of the rankings.")
+    parser.add_argument("--workers", type=int, default=PRECOMPUTE_WORKERS, help="RAG chain runs in flight")
+    parser.add_argument("--limit", type=int, help="Only the first N universities, e.g. to try a prompt change")
+    parser.add_argument("--output", default=PRECOMPUTED_ANSWERS_PATH, help="Answer table file")
+    parser.add_argument("--force", action="store_true", help="Regenerate every answer, changed or not")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be generated")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    from rag.ranking_index import get_ranking_index
+    from rag.query_util import aquery_index
+
+    records: List = get_ranking_index().records
+    table = load_table(args.output)
+    # With --limit, the answers of the other universities are kept
+    summary = asyncio.run(precompute(records[:args.limit], aquery_index, table, workers=args.workers,
+                                     force=args.force, dry_run=args.dry_run, ranked_keys=[record.key for record in records],
+                                     save=lambda table: save_table(table, args.output)))
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
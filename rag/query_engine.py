@@ -0,0 +1,192 @@
+import os
+import asyncio
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+import dotenv
+
+from rag.answer_cache import AnswerCache, cache_key
+from rag.singleflight import SingleFlight
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Query engine configuration
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "8"))  # How many RAG lookups may run at the same time
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "45"))  # Seconds a single lookup may take, waiting time included
+RAG_EXECUTOR = os.getenv("RAG_EXECUTOR", "async")  # "async" uses rag_chain.ainvoke, "thread" runs rag_chain.invoke in a worker pool
+RAG_COALESCE = os.getenv("RAG_COALESCE", "1") == "1"  # Identical questions asked at the same time share one lookup
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a lookup does not finish within the configured timeout."""
+
+
+class QueryEngine:
+    """Runs RAG lookups off the event loop with a bounded number of lookups in flight.
+
+    Every lookup waits for a free slot, then runs either the chain's async path or the blocking
+    path in a worker pool of the same size. The timeout covers both the wait and the lookup itself,
+    and cancelling the awaiting handler cancels the lookup as well.
+
+    With `coalesce`, concurrent lookups whose questions normalize to the same key (see
+    `answer_cache.cache_key`) share one run of the chain, so a burst of the same question in a group
+    costs one Gemini call. Each caller keeps its own timeout; the shared run is cancelled only when
+    every caller has given up."""
+
+    def __init__(
+        self,
+        async_query: Callable[[str], Awaitable[str]],
+        sync_query: Callable[[str], str],
+        max_concurrency: int = RAG_MAX_CONCURRENCY,
+        timeout: float = RAG_TIMEOUT,
+        executor: str = RAG_EXECUTOR,
+        cache: Optional[AnswerCache] = None,
+        async_stream: Optional[Callable[[str], AsyncIterator[str]]] = None,
+        coalesce: bool = RAG_COALESCE,
+        key: Callable[[str], Hashable] = cache_key,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if executor not in ("async", "thread"):
+            raise ValueError(f"Unknown RAG executor: {executor}")
+        self._async_query = async_query
+        self._sync_query = sync_query
+        self._async_stream = async_stream
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.executor = executor
+        self.cache = cache
+        self.key = key
+        self.flights = SingleFlight() if coalesce else None
+        self.in_flight = 0
+        # Created on first use so they bind to the running loop instead of the one at import time
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="rag")
+        return self._pool
+
+    async def _run(self, text: str) -> str:
+        semaphore = self._get_semaphore()
+        await semaphore.acquire()
+        self.in_flight += 1
+
+        def release(future=None):
+            self.in_flight -= 1
+            semaphore.release()
+            if future is not None and not future.cancelled():
+                # Retrieved here in case every caller gave up on the lookup
+                future.exception()
+
+        if self.executor == "thread":
+            # A worker thread cannot be interrupted, so it keeps its slot until it returns, even after a
+            # timeout. The context is copied into the thread for the trace ID of the logs.
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_pool(), contextvars.copy_context().run, self._sync_query, text)
+            future.add_done_callback(release)
+            return await asyncio.shield(future)
+        try:
+            return await self._async_query(text)
+        finally:
+            release()
+
+    async def _compute(self, text: str) -> str:
+        answer = await self._run(text)
+        if self.cache is not None:
+            await self.cache.put(text, answer)
+        return answer
+
+    async def cached(self, text: str) -> Optional[str]:
+        """The cached answer to a question, without starting a lookup."""
+        if self.cache is None:
+            return None
+        return await self.cache.get(text)
+
+    async def query(self, text: str, timeout: Optional[float] = None, check_cache: bool = True) -> str:
+        """The answer to a question, from the cache or a lookup. Callers that already got None from
+        `cached` pass check_cache=False, so the miss isn't counted (or embedded) twice."""
+        if check_cache and self.cache is not None:
+            answer = await self.cache.get(text)
+            if answer is not None:
+                return answer
+        timeout = self.timeout if timeout is None else timeout
+        if self.flights is not None:
+            lookup = self.flights.do(self.key(text), lambda: self._compute(text))
+        else:
+            lookup = self._compute(text)
+        try:
+            return await asyncio.wait_for(lookup, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("RAG lookup timed out after %.1fs: %r", timeout, text)
+            raise QueryTimeoutError(f"Lookup did not finish within {timeout:g} seconds") from None
+
+    async def stream(self, text: str, timeout: Optional[float] = None, check_cache: bool = True) -> AsyncIterator[str]:
+        """Yield the answer in chunks as the chain generates it, under the same limits as query().
+
+        A cached answer is yielded as a single chunk, unless check_cache is False, and the full
+        answer is cached once the stream has been consumed to the end."""
+        if check_cache and self.cache is not None:
+            answer = await self.cache.get(text)
+            if answer is not None:
+                yield answer
+                return
+        if self._async_stream is None:
+            yield await self.query(text, timeout, check_cache=False)
+            return
+        if self.flights is None:
+            chunks = self._stream(text, timeout)
+        else:
+            # Callers joining late get the chunks produced so far first; the first caller's timeout applies
+            chunks = self.flights.stream(self.key(text), lambda: self._stream(text, timeout))
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    async def _stream(self, text: str, timeout: Optional[float]) -> AsyncIterator[str]:
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        semaphore = self._get_semaphore()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise QueryTimeoutError(f"Lookup did not start within {timeout:g} seconds") from None
+        self.in_flight += 1
+        chunks = self._async_stream(text)
+        parts = []
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    logger.warning("RAG stream timed out after %.1fs: %r", timeout, text)
+                    raise QueryTimeoutError(f"Lookup did not finish within {timeout:g} seconds") from None
+                parts.append(chunk)
+                yield chunk
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+            await chunks.aclose()
+        if self.cache is not None:
+            await self.cache.put(text, "".join(parts))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -1,28 +1,15 @@
-from langchain_google_vertexai import VertexAIEmbeddings, ChatVertexAI
-from langchain_mongodb import MongoDBAtlasVectorSearch
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.schema import BaseRetriever
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import LLMChainExtractor
-from langchain_core.prompts import (
-    ChatPromptTemplate, 
-    SystemMessagePromptTemplate, 
-    HumanMessagePromptTemplate, 
-    AIMessagePromptTemplate
-)
-
 import os, logging
+import time
+import asyncio
+import threading
 import warnings
-import json 
-from google.oauth2 import service_account
 from dotenv import load_dotenv
-from rag.mongodb_database import *
+from rag.mongodb_database import get_collection, INDEX_NAME
+from rag.query_engine import QueryEngine
+from rag.answer_cache import AnswerCache, ANSWER_CACHE_SEMANTIC
+from metrics import Gauge, STAGE_LATENCY
 
-# Logging setup
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Logging is configured by logging_pipeline.setup_logging() at startup
 logger = logging.getLogger(__name__) 
 
 warnings.filterwarnings("ignore", category=UserWarning, module="langchain.chains.llm")
@@ -48,24 +35,16 @@ service_account_info=os.getenv('GOOGLE_CREDENTIALS')
 # heroku config:set GOOGLE_APPLICATION_CREDENTIALS="$(cat /gcp_key.json)" -a app-name/glacial-forest-46805
 # created an env in heroku for GOOGLE_APPLICATION_CREDENTIALS.
 
-# Connect to MongoDB
-client = client
-db = db
-COLLECTION_NAME = collection
+# Number of documents fetched from the vector search before compression.
+# With one document per university (INGEST_MODE=university) the best two hits already hold every rank.
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "2" if os.getenv("INGEST_MODE") == "university" else "4"))
 
-# Instantiate VertexAI Embeddings
-embeddings = VertexAIEmbeddings(
-    model_name="text-embedding-004"
-)
+# Where retrieval runs: "atlas" queries Atlas Vector Search, "local" a memory-mapped export of it
+# (python -m rag.local_index export)
+RAG_VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "atlas")
 
-# Instantiate MongoDBAtlasVectorSearch
-vector_search = MongoDBAtlasVectorSearch(
-    embedding=embeddings,
-    collection=COLLECTION_NAME,
-    index_name=INDEX_NAME,
-    text_key="text",
-    embedding_key="embedding"
-)
+# Gemini model used for the answers; precomputed answers are regenerated when it changes
+LLM_MODEL = "gemini-1.5-pro-001"
 
 # Define a prompt for the system
 system_prompt = (
@@ -91,43 +70,188 @@ Occasionally, ask if there are any other universities they would like to know ab
     "\n\n"
     "{context}"
 )
+
+
+# The models, the vector store and the chain are built on first use, or ahead of time by warm_up()
+# once the bot is polling, so importing this module stays cheap and doesn't touch the network.
+# The heavy langchain/vertex imports happen inside the builders for the same reason.
+_build_lock = threading.RLock()
+_embeddings = None
+_llm = None
+_vector_search = None
+_rag_chain = None
+
+# Instantiate VertexAI Embeddings
+def get_embeddings():
+    global _embeddings
+    with _build_lock:
+        if _embeddings is None:
+            from langchain_google_vertexai import VertexAIEmbeddings
+            from rag.embedding_cache import with_embedding_cache
+            # Repeated questions are embedded from the local cache instead of a Vertex AI call
+            _embeddings = with_embedding_cache(VertexAIEmbeddings(
+                model_name="text-embedding-004"
+            ), "text-embedding-004")
+    return _embeddings
+
 # Initialize Gemini AI model 
-llm = ChatVertexAI(
-    model_name="gemini-1.5-pro-001",
-    maxOutputTokens=500,  # The maximum number of tokens to generate in the response
-    temperature=0.5,  # The temperature parameter controls the randomness of the output — the higher the value, the more random the output
-    topP=0.9, # The topP parameter controls the diversity of the output — the higher the value, the more diverse the output
-    topK=20, # The topK parameter controls the diversity of the output — the higher the value, the more diverse the output
-)
+def get_llm():
+    global _llm
+    with _build_lock:
+        if _llm is None:
+            from langchain_google_vertexai import ChatVertexAI
+            _llm = ChatVertexAI(
+                model_name=LLM_MODEL,
+                maxOutputTokens=500,  # The maximum number of tokens to generate in the response
+                temperature=0.5,  # The temperature parameter controls the randomness of the output — the higher the value, the more random the output
+                topP=0.9, # The topP parameter controls the diversity of the output — the higher the value, the more diverse the output
+                topK=20, # The topK parameter controls the diversity of the output — the higher the value, the more diverse the output
+            )
+    return _llm
 
-# Define a compressor and compression retriever
-compressor = LLMChainExtractor.from_llm(llm)
-compression_retriever = ContextualCompressionRetriever(
-    base_compressor = compressor,
-    base_retriever=vector_search.as_retriever()
-)
+# Instantiate MongoDBAtlasVectorSearch
+def get_vector_search():
+    global _vector_search
+    with _build_lock:
+        if _vector_search is None:
+            from langchain_mongodb import MongoDBAtlasVectorSearch
+            _vector_search = MongoDBAtlasVectorSearch(
+                embedding=get_embeddings(),
+                collection=get_collection(),
+                index_name=INDEX_NAME,
+                text_key="text",
+                embedding_key="embedding"
+            )
+    return _vector_search
 
+# Base retriever, returning the similarity score with every document for the rerank stage
+def build_base_retriever():
+    from rag.hybrid import HybridRetriever, MongoLexicalSearch, RAG_HYBRID
+    from rag.ranking_index import get_ranking_index
 
-# Creating the chat prompt template
-prompt = ChatPromptTemplate.from_messages(
-    [
-        SystemMessagePromptTemplate.from_template( system_prompt ),
-        HumanMessagePromptTemplate.from_template("{input}")
-    ]
-)
+    if RAG_VECTOR_BACKEND == "local":
+        from rag.local_index import LocalVectorIndex, LOCAL_INDEX_PATH
+        local_index = LocalVectorIndex.load(LOCAL_INDEX_PATH)
+        if not RAG_HYBRID:
+            return local_index.as_retriever(get_embeddings(), search_kwargs={"k": RAG_TOP_K})
+        lexical = local_index
+        vector_search = lambda query, k, pre_filter: local_index.similarity_search(get_embeddings(), query, k, pre_filter)
+    elif RAG_VECTOR_BACKEND == "atlas":
+        if not RAG_HYBRID:
+            return get_vector_search().as_retriever(
+                search_kwargs={"k": RAG_TOP_K, "additional": ["similarity_score"]}
+            )
+        lexical = MongoLexicalSearch(get_collection)
+        vector_search = lambda query, k, pre_filter: get_vector_search().similarity_search(
+            query, k=k, pre_filter=pre_filter, additional=["similarity_score"]
+        )
+    else:
+        raise ValueError(f"Unknown RAG_VECTOR_BACKEND: {RAG_VECTOR_BACKEND}")
+
+    # Exact university matches skip the vector search, countries pre-filter it (rag/hybrid.py)
+    return HybridRetriever(
+        ranking_index=get_ranking_index, lexical=lexical, vector_search=vector_search, k=RAG_TOP_K
+    )
+
+def get_rag_chain():
+    global _rag_chain
+    with _build_lock:
+        if _rag_chain is None:
+            from langchain.chains import create_retrieval_chain
+            from langchain.chains.combine_documents import create_stuff_documents_chain
+            from langchain.retrievers import ContextualCompressionRetriever
+            from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
+            from rag.rerankers import build_compressor, RAG_COMPRESSOR
+
+            llm = get_llm()
+            base_retriever = build_base_retriever()
+
+            # Define a compressor and compression retriever
+            # The default stages run locally, so answering a question takes exactly one Gemini call.
+            # RAG_COMPRESSOR=llm restores the per-document LLMChainExtractor for comparison.
+            compressor = build_compressor(RAG_COMPRESSOR, llm)
+            if compressor is not None:
+                compression_retriever = ContextualCompressionRetriever(
+                    base_compressor = compressor,
+                    base_retriever=base_retriever
+                )
+            else:
+                compression_retriever = base_retriever
+
+            # Creating the chat prompt template
+            prompt = ChatPromptTemplate.from_messages(
+                [
+                    SystemMessagePromptTemplate.from_template( system_prompt ),
+                    HumanMessagePromptTemplate.from_template("{input}")
+                ]
+            )
+
+            # Create the question-answer chain 
+            question_answer_chain = create_stuff_documents_chain( llm , prompt )
 
-# Create the question-answer chain 
-question_answer_chain = create_stuff_documents_chain( llm , prompt )
+            # Create the retrieval chain using the compression retriever
+            _rag_chain = create_retrieval_chain(compression_retriever, question_answer_chain)
+    return _rag_chain
 
-# Create the retrieval chain using the compression retriever
-rag_chain = create_retrieval_chain(compression_retriever, question_answer_chain)
+# Build everything ahead of the first question; called in the background once the bot is polling
+def warm_up():
+    started = time.perf_counter()
+    get_rag_chain()
+    logger.info("RAG chain ready in %.2fs", time.perf_counter() - started)
+
+# Every run gets its own callback, which times retrieval, compression and generation for /metrics
+def _run_config():
+    from rag.instrumentation import StageTimingCallback
+    callback = StageTimingCallback()
+    return callback, {"callbacks": [callback]}
 
 # Instantiate query_engine
 def query_index(query):
     # Perform the query using the retrieval chain
-    response = rag_chain.invoke({"input": query})
+    callback, config = _run_config()
+    try:
+        with STAGE_LATENCY.time(stage="rag_chain"):
+            response = get_rag_chain().invoke({"input": query}, config=config)
+    finally:
+        callback.finish()
+    return response["answer"]
+
+# Async variant used by the bot, so a lookup never blocks the event loop
+async def aquery_index(query):
+    # Building the chain is blocking, so a question that arrives before warm_up() finished builds it in a thread
+    rag_chain = _rag_chain if _rag_chain is not None else await asyncio.to_thread(get_rag_chain)
+    callback, config = _run_config()
+    try:
+        with STAGE_LATENCY.time(stage="rag_chain"):
+            response = await rag_chain.ainvoke({"input": query}, config=config)
+    finally:
+        callback.finish()
     return response["answer"]
 
+# Streaming variant: yields the answer as Gemini generates it
+async def astream_index(query):
+    rag_chain = _rag_chain if _rag_chain is not None else await asyncio.to_thread(get_rag_chain)
+    callback, config = _run_config()
+    try:
+        with STAGE_LATENCY.time(stage="rag_chain"):
+            async for chunk in rag_chain.astream({"input": query}, config=config):
+                # The retrieval chain streams the input and context first, then the answer token by token
+                if chunk.get("answer"):
+                    yield chunk["answer"]
+    finally:
+        callback.finish()
+
+# Answers are cached by normalized question; paraphrases match too when ANSWER_CACHE_SEMANTIC=1
+answer_cache = AnswerCache(embed=(lambda text: get_embeddings().embed_query(text)) if ANSWER_CACHE_SEMANTIC else None)
+
+# Shared engine that bounds how many lookups run at once and applies the per-request timeout
+query_engine = QueryEngine(aquery_index, query_index, cache=answer_cache, async_stream=astream_index)
+
+# Engine and cache state, read whenever /metrics is scraped
+Gauge("elyuf_rag_in_flight", "RAG lookups currently running", function=lambda: query_engine.in_flight)
+Gauge("elyuf_answer_cache_entries", "Answers in the answer cache", function=lambda: answer_cache.stats()["size"])
+Gauge("elyuf_answer_cache_hit_rate", "Share of lookups answered from the answer cache", function=lambda: answer_cache.stats()["hit_rate"])
+
 # # For testing the function manually
 # if __name__ == "__main__":
 #     test_query = "Hello How are you doing?"
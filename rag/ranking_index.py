@@ -0,0 +1,321 @@
+import os
+import re
+import asyncio
+import logging
+import threading
+import unicodedata
+from difflib import SequenceMatcher
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from ranking_snapshot import load_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Minimum score for a lookup to be answered from the index instead of the RAG chain
+RANKING_MATCH_THRESHOLD = float(os.getenv("RANKING_MATCH_THRESHOLD", "0.88"))
+# Scores of plausible but unconfirmed matches, below the threshold so the question goes to the RAG chain
+PARTIAL_MATCH_SCORE = 0.85
+COMPARISON_SCORE = 0.5
+
+# The three ranking sources, in the order load_data() returns them
+SOURCES = ("qs", "the", "usnews")
+SOURCE_LABELS = {
+    "qs": "QS World University Rank",
+    "the": "Times Higher Education Rank",
+    "usnews": "US News & World Report Rank",
+}
+
+# Words that never distinguish one university from another
+STOP_WORDS = {"the", "of", "and", "at", "in", "for", "de", "du", "la", "le"}
+# Words people wrap around a university name when asking for its rank
+QUERY_FILLER = STOP_WORDS | {
+    "what", "whats", "is", "are", "was", "rank", "ranks", "ranking", "rankings", "position", "place",
+    "please", "pls", "tell", "me", "about", "give", "show", "find", "check", "know", "i", "want", "to",
+    "qs", "times", "higher", "education", "us", "news", "world", "report", "hi", "hello", "hey",
+    "2024", "2025", "2026", "university's", "where", "does", "stand", "a", "an", "its", "it", "can", "you",
+}
+# Words too common to identify a university on their own
+GENERIC_WORDS = {"university", "universite", "universitat", "universidad", "universita", "college", "institute",
+                 "technology", "school", "sciences", "science", "national", "state", "polytechnic", "technical"}
+# Short names people use that can't be derived from the official name
+EXTRA_ALIASES = {
+    "california institute technology": ["caltech"],
+    "eth zurich": ["eth", "swiss federal institute technology"],
+    "london school economics political science": ["lse"],
+    "korea advanced institute science technology": ["kaist"],
+}
+# Informal country names, mapped to the normalized names used in the ranking lists
+COUNTRY_ALIASES = {
+    "usa": "united states",
+    "america": "united states",
+    "uk": "united kingdom",
+    "britain": "united kingdom",
+    "england": "united kingdom",
+    "korea": "south korea",
+}
+
+
+def _strip_accents(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def normalize_name(name: str) -> str:
+    """Case-fold a university name and drop accents, punctuation, parentheticals and stop words."""
+    text = _strip_accents(name).casefold().replace("&", " and ")
+    text = re.sub(r"\(.*?\)", " ", text)
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(word for word in text.split() if word not in STOP_WORDS)
+
+
+def normalize_query(text: str) -> str:
+    """Reduce a free-text question to the words that could be part of a university name."""
+    text = _strip_accents(text).casefold().replace("&", " and ")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(word for word in text.split() if word not in QUERY_FILLER)
+
+
+def _name_aliases(name: str, key: str):
+    """Return (explicit, derived) aliases. Explicit ones are safe to merge sources on, derived
+    acronyms can collide between universities and are only used when unique."""
+    explicit = list(EXTRA_ALIASES.get(key, []))
+    # "Massachusetts Institute of Technology (MIT)" -> "mit"
+    for inner in re.findall(r"\((.*?)\)", name):
+        inner_key = normalize_name(inner)
+        if inner_key:
+            explicit.append(inner_key)
+    # "University College London" -> "ucl"
+    derived = []
+    words = key.split()
+    if len(words) >= 3:
+        derived.append("".join(word[0] for word in words))
+    return explicit, derived
+
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass
+class UniversityRecord:
+    name: str
+    key: str
+    country: Optional[str] = None
+    ranks: Dict[str, str] = field(default_factory=dict)
+    aliases: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Match:
+    record: UniversityRecord
+    score: float
+    method: str
+
+    @property
+    def confident(self) -> bool:
+        return self.score >= RANKING_MATCH_THRESHOLD
+
+
+class RankingIndex:
+    """In-memory index with one record per university holding its QS, THE and US News ranks.
+
+    Lookups try, in order: an exact normalized name or alias, a name mentioned inside the question,
+    a distinctive word that belongs to a single university, and finally trigram candidates verified
+    by edit-distance similarity."""
+
+    def __init__(self, records: List[UniversityRecord], find_key: Optional[Callable[[str], Optional[int]]] = None):
+        self.records = records
+        # Exact names are looked up in the snapshot's sorted table when there is one, else in a dict
+        self._find_key = find_key
+        self._by_key: Dict[str, int] = {}
+        self._by_alias: Dict[str, set] = defaultdict(set)
+        self._by_word: Dict[str, set] = defaultdict(set)
+        self._by_trigram: Dict[str, set] = defaultdict(set)
+        self._countries: Dict[str, str] = {}
+        for idx, record in enumerate(records):
+            if record.country:
+                self._countries.setdefault(normalize_name(record.country), record.country)
+            if find_key is None:
+                self._by_key[record.key] = idx
+            for alias in record.aliases:
+                self._by_alias[alias].add(idx)
+            for word in record.key.split():
+                self._by_word[word].add(idx)
+            for gram in _trigrams(record.key):
+                self._by_trigram[gram].add(idx)
+        # Country names in a question don't name a university
+        self._country_words = {word for key in self._countries for word in key.split()}
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def from_sources(cls, qs_data, times_data, us_news_data) -> "RankingIndex":
+        return cls.from_items(zip(SOURCES, (qs_data, times_data, us_news_data)))
+
+    @classmethod
+    def from_snapshot(cls, snapshot) -> "RankingIndex":
+        """Build the index from the universities a RankingSnapshot already merged, and its name table."""
+        return cls(snapshot.records(), find_key=snapshot.find)
+
+    @classmethod
+    def from_items(cls, items_by_source: Iterable[Tuple[str, list]]) -> "RankingIndex":
+        """Merge ranking lists given as (source, items) pairs into one record per university."""
+        records: List[UniversityRecord] = []
+        by_name: Dict[str, UniversityRecord] = {}  # normalized names and explicit aliases
+        for source, items in items_by_source:
+            for item in items:
+                name = item.get("university")
+                if not name:
+                    continue
+                key = normalize_name(name)
+                explicit, derived = _name_aliases(name, key)
+                # The same university may be spelled differently across sources, e.g. "MIT" in one
+                # and "Massachusetts Institute of Technology (MIT)" in another
+                record = next((by_name[k] for k in [key] + explicit if k in by_name), None)
+                if record is None:
+                    record = UniversityRecord(name=name, key=key, country=item.get("country"))
+                    records.append(record)
+                for k in [key] + explicit:
+                    by_name.setdefault(k, record)
+                if item.get("rank") is not None:
+                    record.ranks.setdefault(source, str(item["rank"]))
+                for alias in [key] + explicit + derived:
+                    if alias != record.key and alias not in record.aliases:
+                        record.aliases.append(alias)
+                if not record.country:
+                    record.country = item.get("country")
+        return cls(records)
+
+    def mentioned_countries(self, text: str) -> List[str]:
+        """Countries of the ranking lists named in the text, as they are spelled in the lists."""
+        padded = f" {normalize_name(text)} "
+        keys = {key for key in self._countries if f" {key} " in padded}
+        keys |= {key for alias, key in COUNTRY_ALIASES.items() if f" {alias} " in padded and key in self._countries}
+        return sorted(self._countries[key] for key in keys)
+
+    def _unique_alias(self, alias: str) -> Optional[int]:
+        ids = self._by_alias.get(alias)
+        if ids and len(ids) == 1:
+            return next(iter(ids))
+        return None
+
+    @staticmethod
+    def _words_match(record: UniversityRecord, tokens: List[str], words: List[str]) -> Optional[Match]:
+        names = [record.key] + record.aliases
+        name_words = {word for name in names for word in name.split()}
+        # Generic words count too: "Michigan State University" is not the University of Michigan
+        if not all(token in name_words for token in tokens):
+            return None
+        if len(words) == len(tokens):
+            # Informal, e.g. "michigan" or "berkeley"
+            return Match(record, 0.9, "words")
+        # A query that reads like a full name ("University of York") must name the university's
+        # first distinctive words, else it may be another university ("New York University")
+        for name in names:
+            distinctive = [word for word in name.split() if word not in GENERIC_WORDS]
+            if set(words) == set(distinctive[:len(words)]):
+                return Match(record, 0.9, "words")
+        return Match(record, PARTIAL_MATCH_SCORE, "words")
+
+    def lookup(self, text: str) -> Optional[Match]:
+        query = normalize_query(text)
+        if not query:
+            return None
+
+        # 1. Exact name or alias
+        idx = self._find_key(query) if self._find_key is not None else self._by_key.get(query)
+        if idx is not None:
+            return Match(self.records[idx], 1.0, "exact")
+        idx = self._unique_alias(query)
+        if idx is not None:
+            return Match(self.records[idx], 1.0, "alias")
+
+        # 2. A full name or alias mentioned inside a longer question, longest mention wins
+        padded = f" {query} "
+        mentioned = [(record.key, idx) for idx, record in enumerate(self.records) if f" {record.key} " in padded]
+        mentioned += [(alias, self._unique_alias(alias)) for alias in self._by_alias
+                      if f" {alias} " in padded and self._unique_alias(alias) is not None]
+        if mentioned:
+            spans = sorted(((padded.index(f" {name} "), len(name), idx) for name, idx in mentioned),
+                           key=lambda span: span[1], reverse=True)
+            start, length, best = spans[0]
+            # A name inside the longest one ("york university" in "new york university") is the same mention;
+            # another university named elsewhere makes it a comparison, which the ranks of one can't answer
+            others = [idx for other_start, other_length, idx in spans[1:]
+                      if idx != best and not (start <= other_start and other_start + other_length <= start + length)]
+            # ... or by a word only another university's name has, e.g. "harvard" in "Is MIT better than Harvard?"
+            rest = (padded[:start] + padded[start + length + 1:]).split()
+            others += [idx for word in rest if word not in GENERIC_WORDS and word not in self._country_words
+                       for idx in self._by_word.get(word, ()) if len(self._by_word[word]) == 1 and idx != best]
+            if others:
+                return Match(self.records[best], COMPARISON_SCORE, "comparison")
+            if len(spans) == 1 or spans[1][1] < length or spans[1][2] == best:
+                return Match(self.records[best], 0.95, "mention")
+
+        # 3. Every distinctive word of the question belongs to one and the same university
+        tokens = query.split()
+        words = [word for word in tokens if word not in GENERIC_WORDS]
+        if words and all(word in self._by_word for word in words):
+            ids = set.intersection(*(self._by_word[word] for word in words))
+            if len(ids) == 1:
+                match = self._words_match(self.records[ids.pop()], tokens, words)
+                if match is not None:
+                    return match
+
+        # 4. Typo-tolerant: trigram candidates, verified with edit-distance similarity
+        grams = _trigrams(query)
+        overlap: Dict[int, int] = defaultdict(int)
+        for gram in grams:
+            for idx in self._by_trigram.get(gram, ()):
+                overlap[idx] += 1
+        if not overlap:
+            return None
+        candidates = sorted(overlap, key=overlap.get, reverse=True)[:8]
+        scored = sorted(
+            ((SequenceMatcher(None, query, self.records[idx].key).ratio(), idx) for idx in candidates),
+            reverse=True,
+        )
+        best_score, best_idx = scored[0]
+        # A near tie between two universities is not a confident answer
+        if len(scored) > 1 and best_score - scored[1][0] < 0.05:
+            best_score = min(best_score, RANKING_MATCH_THRESHOLD - 0.01)
+        return Match(self.records[best_idx], round(best_score, 3), "fuzzy")
+
+
+def format_answer(record: UniversityRecord) -> str:
+    """Format a record the same way the system prompt in query_util asks Gemini to answer."""
+    country = f" ({record.country})" if record.country else ""
+    lines = [f"Hello! 👋 Here are the rankings for {record.name}{country} 🎓", ""]
+    for source in SOURCES:
+        rank = record.ranks.get(source, "Not in the EYUF top 300 list")
+        lines.append(f"• {SOURCE_LABELS[source]}: {rank}")
+    lines += ["", "Is there any other university you would like to know about? 📚✨"]
+    return "\n".join(lines)
+
+
+# Built once, on first use or by the startup warm-up
+_ranking_index: Optional[RankingIndex] = None
+_build_lock = threading.Lock()
+
+def get_ranking_index() -> RankingIndex:
+    global _ranking_index
+    with _build_lock:
+        if _ranking_index is None:
+            try:
+                # The compiled snapshot has the universities merged already, see ranking_snapshot.py
+                index = RankingIndex.from_snapshot(load_snapshot())
+            except OSError as e:
+                logger.warning("Ranking data not available, every lookup will use the RAG chain: %s", e)
+                index = RankingIndex([])
+            logger.info("Ranking index built with %d universities", len(index))
+            _ranking_index = index
+    return _ranking_index
+
+# Async variant used by the bot: loading the snapshot, or compiling it when stale, is blocking,
+# so a message that arrives before warm_up() finished builds the index in a thread
+async def aget_ranking_index() -> RankingIndex:
+    return _ranking_index if _ranking_index is not None else await asyncio.to_thread(get_ranking_index)
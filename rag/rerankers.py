@@ -0,0 +1,133 @@
+import os
+import math
+import logging
+from collections import Counter
+from typing import List, Optional, Sequence
+
+import dotenv
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from langchain_core.documents.compressor import BaseDocumentCompressor
+
+from rag.ranking_index import normalize_name, normalize_query
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Compression/rerank configuration, stages run left to right, e.g. "metadata,score,bm25"
+RAG_COMPRESSOR = os.getenv("RAG_COMPRESSOR", "metadata,score")
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.7"))  # Atlas cosine vectorSearchScore, normalized to 0..1
+RAG_RERANK_TOP_N = int(os.getenv("RAG_RERANK_TOP_N", "3"))  # Documents handed to Gemini after reranking
+
+
+def _tokens(text: str) -> List[str]:
+    return normalize_query(text).split()
+
+
+class MetadataFilterCompressor(BaseDocumentCompressor):
+    """Keeps the documents whose `university` metadata shares the most words with the question.
+
+    Documents for other universities that only happened to be close in vector space are dropped.
+    When no document's university is mentioned at all, everything is kept."""
+
+    field: str = "university"
+
+    def compress_documents(
+        self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None
+    ) -> Sequence[Document]:
+        query_words = set(_tokens(query))
+        overlaps = [
+            len(query_words & set(normalize_name(str(doc.metadata.get(self.field) or "")).split()))
+            for doc in documents
+        ]
+        best = max(overlaps, default=0)
+        if best == 0:
+            return list(documents)
+        return [doc for doc, overlap in zip(documents, overlaps) if overlap == best]
+
+
+class ScoreThresholdCompressor(BaseDocumentCompressor):
+    """Reorders documents by their vector search similarity and prunes the weak ones.
+
+    Atlas already computed the cosine similarity between the query and each stored embedding, and the
+    retriever returns it as `score` metadata, so this costs no extra embedding call."""
+
+    min_score: float = RAG_MIN_SCORE
+    top_n: int = RAG_RERANK_TOP_N
+    min_keep: int = 1
+
+    def compress_documents(
+        self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None
+    ) -> Sequence[Document]:
+        ranked = sorted(documents, key=lambda doc: doc.metadata.get("score", 0.0), reverse=True)
+        kept = [doc for doc in ranked if doc.metadata.get("score", 0.0) >= self.min_score]
+        if len(kept) < self.min_keep:
+            kept = ranked[:self.min_keep]
+        return kept[:self.top_n]
+
+
+class BM25Compressor(BaseDocumentCompressor):
+    """Reranks the retrieved documents with BM25 against the question and keeps the top ones."""
+
+    top_n: int = RAG_RERANK_TOP_N
+    k1: float = 1.5
+    b: float = 0.75
+
+    def compress_documents(
+        self, documents: Sequence[Document], query: str, callbacks: Optional[Callbacks] = None
+    ) -> Sequence[Document]:
+        if not documents:
+            return []
+        query_words = set(_tokens(query))
+        doc_words = [_tokens(doc.page_content) for doc in documents]
+        avg_len = sum(len(words) for words in doc_words) / len(doc_words) or 1.0
+        doc_freq = Counter(word for words in doc_words for word in set(words))
+        n_docs = len(documents)
+
+        def score(words: List[str]) -> float:
+            counts = Counter(words)
+            total = 0.0
+            for word in query_words:
+                tf = counts.get(word, 0)
+                if not tf:
+                    continue
+                idf = math.log(1 + (n_docs - doc_freq[word] + 0.5) / (doc_freq[word] + 0.5))
+                total += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * len(words) / avg_len))
+            return total
+
+        scored = sorted(zip((score(words) for words in doc_words), range(n_docs)), reverse=True)
+        # Stable for ties, so the vector search order decides between equally good documents
+        return [documents[idx] for _, idx in scored[:self.top_n]]
+
+
+def build_compressor(spec: str = RAG_COMPRESSOR, llm=None) -> Optional[BaseDocumentCompressor]:
+    """Build the compression stage from a comma separated list of stages.
+
+    Stages: "metadata", "score", "bm25", and "llm" for the original per-document LLMChainExtractor,
+    which costs one Gemini call per retrieved document. "none" or an empty spec disables compression."""
+    stages: List[BaseDocumentCompressor] = []
+    for name in (part.strip().lower() for part in spec.split(",")):
+        if name in ("", "none"):
+            continue
+        if name == "metadata":
+            stages.append(MetadataFilterCompressor())
+        elif name == "score":
+            stages.append(ScoreThresholdCompressor())
+        elif name == "bm25":
+            stages.append(BM25Compressor())
+        elif name == "llm":
+            if llm is None:
+                raise ValueError("The llm compression stage needs an llm")
+            from langchain.retrievers.document_compressors import LLMChainExtractor
+            stages.append(LLMChainExtractor.from_llm(llm))
+        else:
+            raise ValueError(f"Unknown compression stage: {name}")
+    logger.info("Compression stages: %s", [type(stage).__name__ for stage in stages] or "none")
+    if not stages:
+        return None
+    if len(stages) == 1:
+        return stages[0]
+    from langchain.retrievers.document_compressors import DocumentCompressorPipeline
+    return DocumentCompressorPipeline(transformers=stages)
@@ -0,0 +1,210 @@
+"""Answers for messages that list several universities, e.g. an applicant's shortlist.
+
+The list is split on lines, numbering or commas. Every name the ranking index resolves confidently is
+answered from it directly. The remaining names are scored against all universities at once: each
+name and each university becomes a hashed character-trigram vector, and one matrix product gives
+every name's nearest universities. Names with plausible candidates are then settled by a single LLM
+call that only picks among those candidates, so the answer is one table with at most one LLM call.
+"""
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import dotenv
+import numpy as np
+
+from metrics import LLM_CALLS, STAGE_LATENCY
+from rag.ranking_index import RankingIndex, UniversityRecord, SOURCES, normalize_query
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Shortlist configuration
+SHORTLIST_MAX_ITEMS = int(os.getenv("SHORTLIST_MAX_ITEMS", "20"))  # Names answered per message, the rest are ignored
+SHORTLIST_MIN_SIMILARITY = float(os.getenv("SHORTLIST_MIN_SIMILARITY", "0.35"))  # Trigram cosine for a candidate
+SHORTLIST_CANDIDATES = 3  # Candidates per unresolved name shown to the LLM
+HASH_DIMENSIONS = 4096
+SHORT_LABELS = {"qs": "QS", "the": "THE", "usnews": "US News"}
+
+NUMBERING = re.compile(r"^\s*(?:\d{1,2}\s*[.)]|[-•*–])\s*")
+INLINE_NUMBERING = re.compile(r"(?:^|\s)\d{1,2}[.)]\s+")
+CHOICE = re.compile(r"^\s*(\d+)\s*[:.)-]\s*([a-z0])\b", re.IGNORECASE | re.MULTILINE)
+
+
+@dataclass
+class Shortlist:
+    items: List[str]
+    resolved: List[Optional[UniversityRecord]]
+    candidates: List[List[Tuple[UniversityRecord, float]]] = field(default_factory=list)
+
+    @property
+    def unresolved(self) -> List[int]:
+        return [i for i, record in enumerate(self.resolved) if record is None and self.candidates[i]]
+
+
+def split_items(text: str) -> Tuple[List[str], bool]:
+    """Split a message into list items. The flag tells whether the split was on commas only."""
+    lines = [line for line in text.splitlines() if line.strip()]
+    by_comma = False
+    if len(lines) >= 2:
+        parts = lines
+    elif len(INLINE_NUMBERING.findall(text)) >= 2:
+        parts = INLINE_NUMBERING.split(text)
+    else:
+        parts, by_comma = re.split(r"[;,]", text), True
+    items = []
+    for part in parts:
+        # A line like "Here is my list:" introduces the items, it isn't one
+        if part.strip().endswith(":"):
+            continue
+        item = NUMBERING.sub("", part).strip(" \t.;,?!")
+        if item:
+            items.append(item)
+    return items, by_comma
+
+
+def _trigram_vector(text: str) -> np.ndarray:
+    vector = np.zeros(HASH_DIMENSIONS, dtype=np.float32)
+    padded = f"  {text} "
+    for i in range(len(padded) - 2):
+        bucket = int.from_bytes(hashlib.blake2b(padded[i:i + 3].encode(), digest_size=4).digest(), "little")
+        vector[bucket % HASH_DIMENSIONS] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class NameMatrix:
+    """Hashed trigram vectors of every university name in a RankingIndex, one row per record."""
+
+    def __init__(self, index: RankingIndex):
+        self.index = index
+        self.matrix = np.stack([_trigram_vector(record.key) for record in index.records]) if len(index) else \
+            np.zeros((0, HASH_DIMENSIONS), dtype=np.float32)
+
+    def nearest(self, names: List[str], top: int = SHORTLIST_CANDIDATES,
+                min_similarity: float = SHORTLIST_MIN_SIMILARITY) -> List[List[Tuple[UniversityRecord, float]]]:
+        """Best matching records for every name, from a single (names x universities) matrix product."""
+        if not names or not len(self.matrix):
+            return [[] for _ in names]
+        queries = np.stack([_trigram_vector(normalize_query(name)) for name in names])
+        scores = queries @ self.matrix.T
+        top = min(top, scores.shape[1])
+        best = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+        results = []
+        for row, columns in enumerate(best):
+            ranked = sorted(columns, key=lambda column: -scores[row, column])
+            results.append([(self.index.records[column], float(scores[row, column]))
+                            for column in ranked if scores[row, column] >= min_similarity])
+        return results
+
+
+_name_matrix: Optional[NameMatrix] = None
+
+def get_name_matrix(index: RankingIndex) -> NameMatrix:
+    global _name_matrix
+    if _name_matrix is None or _name_matrix.index is not index:
+        _name_matrix = NameMatrix(index)
+    return _name_matrix
+
+
+def parse_shortlist(text: str, index: RankingIndex) -> Optional[Shortlist]:
+    """A Shortlist when the message lists at least two universities, otherwise None."""
+    match = index.lookup(text)
+    # A single university whose name contains a comma, e.g. "University of California, Berkeley"
+    if match is not None and match.confident and ("," in match.record.name or match.method in ("exact", "alias")):
+        return None
+    items, by_comma = split_items(text)
+    if len(items) < 2:
+        return None
+    items = items[:SHORTLIST_MAX_ITEMS]
+
+    with STAGE_LATENCY.time(stage="shortlist_resolve"):
+        resolved = []
+        for item in items:
+            item_match = index.lookup(item)
+            resolved.append(item_match.record if item_match is not None and item_match.confident else None)
+        pending = [i for i, record in enumerate(resolved) if record is None]
+        nearest = get_name_matrix(index).nearest([items[i] for i in pending])
+        candidates: List[List[Tuple[UniversityRecord, float]]] = [[] for _ in items]
+        for i, found in zip(pending, nearest):
+            candidates[i] = found
+
+    recognized = sum(1 for i in range(len(items)) if resolved[i] is not None or candidates[i])
+    # Commas also appear in ordinary questions, so a comma list must consist of confident names
+    if by_comma and sum(1 for record in resolved if record is not None) < 2:
+        return None
+    if recognized < 2:
+        return None
+    return Shortlist(items, resolved, candidates)
+
+
+def build_choice_prompt(shortlist: Shortlist) -> str:
+    lines = [
+        "You match university names typed by a user to entries of a university ranking list.",
+        "For each numbered name, answer with the letter of the candidate that is the same university, "
+        "or 0 if none of them is. Answer with one line per name in the form `<number>: <letter>` and nothing else.",
+        "",
+    ]
+    for number, i in enumerate(shortlist.unresolved, start=1):
+        lines.append(f'{number}. "{shortlist.items[i]}"')
+        for letter, (record, _) in zip("abcdefgh", shortlist.candidates[i]):
+            country = f" ({record.country})" if record.country else ""
+            lines.append(f"   {letter}) {record.name}{country}")
+    return "\n".join(lines)
+
+
+def apply_choices(shortlist: Shortlist, reply: str):
+    """Resolve the unresolved names from the LLM's `<number>: <letter>` lines."""
+    unresolved = shortlist.unresolved
+    for number, letter in CHOICE.findall(reply):
+        position = int(number) - 1
+        if not 0 <= position < len(unresolved) or letter == "0":
+            continue
+        i = unresolved[position]
+        choice = "abcdefgh".find(letter.lower())
+        if 0 <= choice < len(shortlist.candidates[i]):
+            shortlist.resolved[i] = shortlist.candidates[i][choice][0]
+
+
+async def resolve_with_llm(shortlist: Shortlist, get_llm, timeout: float):
+    """Settle every name the index couldn't resolve with one LLM call. Failures leave them unresolved."""
+    if not shortlist.unresolved:
+        return
+    LLM_CALLS.inc(stage="shortlist")
+    try:
+        with STAGE_LATENCY.time(stage="shortlist_llm"):
+            llm = await asyncio.to_thread(get_llm)
+            reply = await asyncio.wait_for(llm.ainvoke(build_choice_prompt(shortlist)), timeout)
+    except Exception as e:
+        logger.warning("Shortlist LLM call failed, %d names left unresolved: %s", len(shortlist.unresolved), e)
+        return
+    apply_choices(shortlist, getattr(reply, "content", str(reply)))
+
+
+def format_shortlist(shortlist: Shortlist) -> str:
+    """One block per university in the order they were asked, then the names that weren't found."""
+    lines = ["Hello! 👋 Here are the rankings for your shortlist 🎓", ""]
+    seen, missing = set(), []
+    number = 0
+    for item, record in zip(shortlist.items, shortlist.resolved):
+        if record is None:
+            missing.append(item)
+            continue
+        if record.key in seen:
+            continue
+        seen.add(record.key)
+        number += 1
+        country = f" ({record.country})" if record.country else ""
+        lines.append(f"{number}. {record.name}{country}")
+        ranks = " · ".join(f"{SHORT_LABELS[source]}: {record.ranks.get(source, '—')}" for source in SOURCES)
+        lines.append(f"   {ranks}")
+    if missing:
+        lines += ["", "Not in the EYUF top 300 list (or check the spelling): " + ", ".join(missing)]
+    lines += ["", "Is there any other university you would like to know about? 📚✨"]
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+COALESCED = Counter("elyuf_rag_coalesced_total", "Lookups that joined an identical lookup already in flight", ["mode"])
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class _Broadcast:
+    """Chunks of one shared stream, replayed to every subscriber from the start."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+
+    def notify(self):
+        self._wake.set()
+        self._wake = asyncio.Event()
+
+    async def wait(self):
+        await self._wake.wait()
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one computation.
+
+    The first caller for a key starts the computation as a task, and callers arriving while it runs
+    wait for the same task. The result goes to all of them, and so does an error. Nothing is kept once
+    the task finishes, so a failed computation is retried by the next call. A caller that is cancelled
+    or times out only stops waiting. The computation is cancelled when its last caller has left.
+
+    `stream` does the same for async iterators: every subscriber gets all chunks from the beginning,
+    including the ones produced before it joined."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+        self.executed = 0
+        self.deduplicated = 0
+
+    def _forget(self, registry: dict, key: Hashable, entry):
+        if registry.get(key) is entry:
+            del registry[key]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+            self.executed += 1
+        else:
+            self.deduplicated += 1
+            COALESCED.inc(mode="query")
+        call.waiters += 1
+        try:
+            # shield: cancelling one waiter must not cancel the computation the others are waiting for
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+
+    async def _produce(self, broadcast: _Broadcast, chunks: AsyncIterator[str]):
+        try:
+            async for chunk in chunks:
+                broadcast.chunks.append(chunk)
+                broadcast.notify()
+        except asyncio.CancelledError:
+            # Only reaches subscribers when the producer was cancelled from outside, e.g. on shutdown
+            broadcast.error = RuntimeError("The shared lookup was cancelled")
+            raise
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            broadcast.done = True
+            broadcast.notify()
+            # Run the source's cleanup (its semaphore slot) now rather than when it's garbage collected
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def stream(self, key: Hashable, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = self._streams[key] = _Broadcast()
+            broadcast.task = asyncio.ensure_future(self._produce(broadcast, fn()))
+            broadcast.task.add_done_callback(lambda _: self._forget(self._streams, key, broadcast))
+            self.executed += 1
+        else:
+            self.deduplicated += 1
+            COALESCED.inc(mode="stream")
+        broadcast.subscribers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(broadcast.chunks):
+                    position += 1
+                    yield broadcast.chunks[position - 1]
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                await broadcast.wait()
+        finally:
+            broadcast.subscribers -= 1
+            if not broadcast.subscribers and not broadcast.done:
+                self._forget(self._streams, key, broadcast)
+                broadcast.task.cancel()
+
+    def stats(self) -> dict:
+        return {"executed": self.executed, "deduplicated": self.deduplicated,
+                "in_flight": len(self._calls) + len(self._streams)}
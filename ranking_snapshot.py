@@ -0,0 +1,331 @@
+"""Compiled binary snapshot of the ranking JSON files.
+
+The snapshot holds every source's rows as array columns over one table of interned strings, the
+universities merged across sources the way RankingIndex merges them, and a sorted table of their
+normalized names for lookups. It is memory-mapped, so loading it costs an open and a header parse;
+strings are decoded on first use. The header records the SHA-256, size and mtime of each source
+file, and a snapshot whose sources changed is compiled again on the next load.
+
+Layout: the magic bytes, a format version and the length of a JSON header, the header itself
+(sources, and offset/dtype/length of every section), then the sections, each aligned to 8 bytes.
+
+Usage: python ranking_snapshot.py [build|stats] [--data-dir DIR]
+"""
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import dotenv
+import numpy as np
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ELYUFRNK"
+SNAPSHOT_VERSION = 1
+PREAMBLE = struct.Struct("<8sII")  # magic, format version, header length
+NO_VALUE = -1
+MAX_PACKED_RANK = 2 ** 31 - 1  # Largest integer rank the int32 rank column holds
+
+# The files load_data() reads, relative to the working directory, and the snapshot compiled from them
+RANKING_FILES = (("qs", "data/init-QS.json"), ("the", "data/init-Times.json"), ("usnews", "data/init-US&NEWS.json"))
+RANKING_SNAPSHOT = os.getenv("RANKING_SNAPSHOT", "data/rankings.snapshot")
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+def _read_source(name: Optional[str], path: str) -> Tuple[str, list, dict]:
+    """(source name, rows, file info) of a ranking JSON file. A file that isn't valid JSON has no rows."""
+    with open(path, "rb") as source:
+        raw = source.read()
+    info = {"file": path, "sha256": hashlib.sha256(raw).hexdigest(), "size": len(raw),
+            "mtime_ns": os.stat(path).st_mtime_ns}
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError as e:
+        logger.error("Error loading %s: %s", path, e)
+        data = {}
+    rows = data.get("data") if isinstance(data, dict) else None
+    if not isinstance(rows, list):
+        logger.warning("'data' list not found in %s, it has no rows", path)
+        rows = []
+    if name is None:
+        name = (data.get("source") if isinstance(data, dict) else None) or os.path.splitext(os.path.basename(path))[0]
+    return name, rows, info
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return NO_VALUE
+        value = str(value)
+        if value not in self.ids:
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        return self.ids[value]
+
+
+def _encode_rank(strings: _StringTable, rank) -> Optional[int]:
+    # Integer ranks that fit the column are stored as they are, strings ("=12", "201-250") as -2 - their
+    # string ID. Anything else (a float, a bool, a negative or too large integer) returns None.
+    if rank is None:
+        return NO_VALUE
+    if isinstance(rank, str):
+        return -2 - strings.add(rank)
+    if isinstance(rank, int) and not isinstance(rank, bool) and 0 <= rank <= MAX_PACKED_RANK:
+        return rank
+    return None
+
+
+def compile_snapshot(sources: Sequence[Tuple[Optional[str], str]]) -> bytes:
+    """Compile (source name, JSON path) pairs into snapshot bytes. A None name is taken from the file."""
+    from rag.ranking_index import RankingIndex
+
+    strings = _StringTable()
+    sections: Dict[str, np.ndarray] = {}
+    infos, items_by_source = [], []
+    for position, (name, path) in enumerate(sources):
+        name, rows, info = _read_source(name, path)
+        columns = {"university": [], "country": [], "rank": [], "extra": []}
+        for row in rows:
+            columns["university"].append(strings.add(row.get("university")))
+            columns["country"].append(strings.add(row.get("country")))
+            rank = _encode_rank(strings, row.get("rank"))
+            extra = {key: value for key, value in row.items() if key not in ("university", "country", "rank")}
+            if rank is None:
+                # Kept with its JSON type among the other fields, items() puts it back as the rank
+                extra["rank"] = row["rank"]
+                rank = NO_VALUE
+            columns["rank"].append(rank)
+            columns["extra"].append(strings.add(json.dumps(extra, ensure_ascii=False)) if extra else NO_VALUE)
+        for column, values in columns.items():
+            sections[f"rows.{position}.{column}"] = np.asarray(values, dtype=np.int32)
+        infos.append({"name": name, "rows": len(rows), **info})
+        items_by_source.append((name, rows))
+
+    records = RankingIndex.from_items(items_by_source).records
+    source_names = [info["name"] for info in infos]
+    ranks = np.full((len(records), len(source_names)), NO_VALUE, dtype=np.int32)
+    alias_offsets, aliases = [0], []
+    for idx, record in enumerate(records):
+        for position, source in enumerate(source_names):
+            if source in record.ranks:
+                ranks[idx, position] = strings.add(record.ranks[source])
+        aliases.extend(strings.add(alias) for alias in record.aliases)
+        alias_offsets.append(len(aliases))
+    sections["records.name"] = np.asarray([strings.add(record.name) for record in records], dtype=np.int32)
+    sections["records.key"] = np.asarray([strings.add(record.key) for record in records], dtype=np.int32)
+    sections["records.country"] = np.asarray([strings.add(record.country) for record in records], dtype=np.int32)
+    sections["records.ranks"] = ranks.reshape(-1)
+    sections["records.alias_offsets"] = np.asarray(alias_offsets, dtype=np.uint32)
+    sections["records.aliases"] = np.asarray(aliases, dtype=np.int32)
+    # Normalized names sorted by their UTF-8 bytes, for binary search without decoding the table
+    order = sorted(range(len(records)), key=lambda idx: records[idx].key.encode("utf-8"))
+    sections["lookup.keys"] = sections["records.key"][order] if records else np.zeros(0, dtype=np.int32)
+    sections["lookup.records"] = np.asarray(order, dtype=np.int32)
+
+    encoded = [value.encode("utf-8") for value in strings.values]
+    sections["strings.offsets"] = np.cumsum([0] + [len(value) for value in encoded], dtype=np.uint64).astype(np.uint32)
+    sections["strings.data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    # Section offsets depend on the header length, so lay the sections out relative to the data start
+    layout, body, position = {}, [], 0
+    for name, array in sections.items():
+        padding = -position % 8
+        body.append(b"\0" * padding)
+        position += padding
+        layout[name] = [position, array.dtype.str, int(array.size)]
+        body.append(array.tobytes())
+        position += array.nbytes
+    header = json.dumps({"version": SNAPSHOT_VERSION, "sources": infos, "records": len(records),
+                         "strings": len(strings.values), "sections": layout}).encode("utf-8")
+    header += b" " * (-(PREAMBLE.size + len(header)) % 8)
+    return PREAMBLE.pack(MAGIC, SNAPSHOT_VERSION, len(header)) + header + b"".join(body)
+
+
+def write_snapshot(payload: bytes, path: str) -> str:
+    """Atomically replace the snapshot at path, so running processes keep their mapping of the old one."""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as snapshot:
+        snapshot.write(payload)
+    os.replace(tmp_path, path)
+    logger.info("Wrote ranking snapshot %s (%d bytes)", path, len(payload))
+    return path
+
+
+class RankingSnapshot:
+    """Read-only view of a compiled snapshot, backed by mmap or by the bytes of a fresh compile."""
+
+    def __init__(self, buffer, path: Optional[str] = None):
+        self.path = path
+        self._buffer = buffer
+        magic, version, header_length = PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Not a version {SNAPSHOT_VERSION} ranking snapshot")
+        start = PREAMBLE.size + header_length
+        self.header = json.loads(bytes(buffer[PREAMBLE.size:start]))
+        self._arrays = {
+            name: np.frombuffer(buffer, dtype=np.dtype(dtype), count=count, offset=start + offset)
+            for name, (offset, dtype, count) in self.header["sections"].items()
+        }
+        self.source_names: List[str] = [info["name"] for info in self.header["sources"]]
+        self._offsets = self._arrays["strings.offsets"]
+        self._data = self._arrays["strings.data"]
+        self._strings: List[Optional[str]] = [None] * self.header["strings"]
+
+    @classmethod
+    def open(cls, path: str) -> "RankingSnapshot":
+        with open(path, "rb") as snapshot:
+            # The mapping stays valid after the file is closed, and even after the file is replaced
+            buffer = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path)
+
+    def __len__(self) -> int:
+        return self.header["records"]
+
+    def string(self, string_id: int) -> Optional[str]:
+        if string_id < 0:
+            return None
+        value = self._strings[string_id]
+        if value is None:
+            start, end = int(self._offsets[string_id]), int(self._offsets[string_id + 1])
+            value = self._strings[string_id] = sys.intern(self._data[start:end].tobytes().decode("utf-8"))
+        return value
+
+    def _rank(self, encoded: int):
+        if encoded >= 0:
+            return int(encoded)
+        if encoded == NO_VALUE:
+            return None
+        return self.string(-2 - int(encoded))
+
+    def is_fresh(self, sources: Sequence[Tuple[Optional[str], str]]) -> bool:
+        """Whether the snapshot was compiled from these files as they are now."""
+        if len(sources) != len(self.header["sources"]):
+            return False
+        for (name, path), info in zip(sources, self.header["sources"]):
+            if os.path.abspath(path) != os.path.abspath(info["file"]) or (name is not None and name != info["name"]):
+                return False
+            stat = os.stat(path)
+            if stat.st_size == info["size"] and stat.st_mtime_ns == info["mtime_ns"]:
+                continue
+            # Touched but possibly unchanged, e.g. after a checkout: the content decides
+            if stat.st_size != info["size"] or file_hash(path) != info["sha256"]:
+                return False
+        return True
+
+    def items(self, position: int) -> List[dict]:
+        """The rows of one source as the dicts json.load would have returned."""
+        column = lambda name: self._arrays[f"rows.{position}.{name}"]
+        rows = []
+        for university, country, rank, extra in zip(column("university"), column("country"), column("rank"), column("extra")):
+            row = {"rank": self._rank(rank), "university": self.string(university), "country": self.string(country)}
+            if extra != NO_VALUE:
+                row.update(json.loads(self.string(extra)))
+            rows.append(row)
+        return rows
+
+    def items_by_source(self) -> List[Tuple[str, list]]:
+        return [(name, self.items(position)) for position, name in enumerate(self.source_names)]
+
+    def records(self):
+        """The universities merged across sources, as RankingIndex.from_items would build them."""
+        from rag.ranking_index import UniversityRecord
+
+        ranks = self._arrays["records.ranks"].reshape(len(self), len(self.source_names))
+        alias_offsets, aliases = self._arrays["records.alias_offsets"], self._arrays["records.aliases"]
+        records = []
+        for idx in range(len(self)):
+            records.append(UniversityRecord(
+                name=self.string(int(self._arrays["records.name"][idx])),
+                key=self.string(int(self._arrays["records.key"][idx])),
+                country=self.string(int(self._arrays["records.country"][idx])),
+                ranks={source: self.string(int(ranks[idx, position]))
+                       for position, source in enumerate(self.source_names) if ranks[idx, position] != NO_VALUE},
+                aliases=[self.string(int(alias)) for alias in aliases[alias_offsets[idx]:alias_offsets[idx + 1]]],
+            ))
+        return records
+
+    def find(self, key: str) -> Optional[int]:
+        """Index of the university with this normalized name, by binary search over the lookup table."""
+        target = key.encode("utf-8")
+        keys, low, high = self._arrays["lookup.keys"], 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            string_id = int(keys[middle])
+            value = self._data[int(self._offsets[string_id]):int(self._offsets[string_id + 1])].tobytes()
+            if value < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self):
+            string_id = int(keys[low])
+            if self._data[int(self._offsets[string_id]):int(self._offsets[string_id + 1])].tobytes() == target:
+                return int(self._arrays["lookup.records"][low])
+        return None
+
+
+def load_snapshot(sources: Sequence[Tuple[Optional[str], str]] = RANKING_FILES,
+                  path: str = RANKING_SNAPSHOT) -> RankingSnapshot:
+    """The snapshot of the sources, compiled again first when it is missing or stale.
+
+    A snapshot that can't be written (e.g. a read-only checkout) is used from memory. Missing source
+    files raise OSError, like reading them directly would."""
+    try:
+        snapshot = RankingSnapshot.open(path)
+        if snapshot.is_fresh(sources):
+            return snapshot
+        logger.info("Ranking snapshot %s is stale, compiling it again", path)
+    except (OSError, ValueError, KeyError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logger.warning("Ranking snapshot %s unreadable, compiling it again: %s", path, e)
+    payload = compile_snapshot(sources)
+    try:
+        return RankingSnapshot.open(write_snapshot(payload, path))
+    except OSError as e:
+        logger.warning("Could not write the ranking snapshot to %s, using it from memory: %s", path, e)
+        return RankingSnapshot(payload, path=None)
+
+
+def directory_sources(data_dir: str) -> List[Tuple[Optional[str], str]]:
+    """Every JSON file of a directory, named by its `source` field or its file name (see rag.ingest)."""
+    return [(None, os.path.join(data_dir, name)) for name in sorted(os.listdir(data_dir)) if name.endswith(".json")]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compile the ranking JSON files into a binary snapshot.")
+    parser.add_argument("command", nargs="?", choices=("build", "stats"), default="build")
+    parser.add_argument("--data-dir", help="Compile every JSON file of this directory instead of load_data()'s files")
+    parser.add_argument("--output", help="Snapshot path, by default RANKING_SNAPSHOT or DATA_DIR/rankings.snapshot")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    sources = directory_sources(args.data_dir) if args.data_dir else list(RANKING_FILES)
+    path = args.output or (os.path.join(args.data_dir, "rankings.snapshot") if args.data_dir else RANKING_SNAPSHOT)
+    snapshot = load_snapshot(sources, path) if args.command == "stats" else RankingSnapshot.open(write_snapshot(compile_snapshot(sources), path))
+    for info in snapshot.header["sources"]:
+        print(f"{info['name']}: {info['rows']} rows from {info['file']} (sha256 {info['sha256'][:12]})")
+    print(f"{len(snapshot)} universities, {snapshot.header['strings']} distinct strings, "
+          f"{os.path.getsize(path) if os.path.exists(path) else 0} bytes in {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -65,6 +65,7 @@ setup(
         'markdown-it-py==3.0.0',
         'marshmallow==3.21.3',
         'mdurl==0.1.2',
+        'motor==3.5.0',
         'multidict==6.0.5',
         'mypy-extensions==1.0.0',
         'numpy==1.26.4',
@@ -104,6 +105,7 @@ setup(
         'tenacity==8.4.2',
         'toml==0.10.2',
         'tomlkit==0.12.5',
+        'tornado==6.4.1',
         'typer==0.9.4',
         'typing-inspect==0.9.0',
         'typing_extensions==4.12.2',
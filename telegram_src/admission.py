@@ -0,0 +1,176 @@
+"""Admission control in front of the RAG path.
+
+A message that needs Gemini first has to pass the sender's token bucket, then get one of
+ADMISSION_MAX_ACTIVE slots. When all slots are taken it waits in a bounded priority queue, where
+private chats go ahead of group mentions. A message is shed, and answered with a short "busy"
+reply, when its sender is over their rate, when the queue is full, or when it has waited
+ADMISSION_MAX_WAIT seconds without getting a slot. A private message arriving at a full queue
+takes the place of the most recently queued group mention.
+"""
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import dotenv
+
+from metrics import Counter, Gauge, Histogram
+from rag.query_engine import RAG_MAX_CONCURRENCY
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Admission configuration
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", str(RAG_MAX_CONCURRENCY)))  # RAG requests handled at once
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))  # Requests waiting for a slot, the rest are shed
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "15"))  # Seconds a request may wait for a slot
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "5"))  # RAG requests a user may send in a row
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "0.2"))  # Tokens a user gets back per second
+
+PRIVATE, GROUP = 0, 1
+PRIORITY_NAMES = {PRIVATE: "private", GROUP: "group"}
+
+DECISIONS = Counter("elyuf_admission_total", "Admission decisions for RAG requests", ["result", "priority"])
+QUEUE_WAIT = Histogram("elyuf_admission_wait_seconds", "Time admitted requests waited for a slot", ["priority"])
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed. `reason` is rate_limited, queue_full, timeout or preempted."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBucket:
+    """Per-key token buckets holding up to `burst` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, burst: float = ADMISSION_USER_BURST, rate: float = ADMISSION_USER_RATE):
+        self.burst = burst
+        self.rate = rate
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self._last_prune = time.monotonic()
+
+    def take(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1.0
+        self._buckets[key] = (tokens - 1.0 if allowed else tokens, now)
+        self._prune(now)
+        return allowed
+
+    def _prune(self, now: float):
+        # A bucket that has refilled completely is the same as no bucket, drop those once a minute
+        if now - self._last_prune < 60 or not self.rate:
+            return
+        self._last_prune = now
+        full_after = self.burst / self.rate
+        for key in [key for key, (_, updated) in self._buckets.items() if now - updated >= full_after]:
+            del self._buckets[key]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class AdmissionController:
+    """Token buckets, a fixed number of slots and a bounded priority queue, see the module docstring.
+
+    Use `async with controller.admit(user_id, priority):` around the work; it raises
+    AdmissionRejected when the request is shed."""
+
+    def __init__(
+        self,
+        max_active: int = ADMISSION_MAX_ACTIVE,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        max_wait: float = ADMISSION_MAX_WAIT,
+        buckets: Optional[TokenBucket] = None,
+    ):
+        if max_active < 1:
+            raise ValueError("max_active must be at least 1")
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.buckets = buckets if buckets is not None else TokenBucket()
+        self.active = 0
+        # (priority, arrival, future): private chats first, then first come first served
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for _, _, future in self._queue if not future.done())
+
+    def _reject(self, reason: str, priority: int):
+        DECISIONS.inc(result=reason, priority=PRIORITY_NAMES[priority])
+        raise AdmissionRejected(reason)
+
+    def _preempt_group_waiter(self) -> bool:
+        waiting = [entry for entry in self._queue if entry[0] == GROUP and not entry[2].done()]
+        if not waiting:
+            return False
+        entry = max(waiting, key=lambda entry: entry[1])
+        entry[2].set_exception(AdmissionRejected("preempted"))
+        DECISIONS.inc(result="preempted", priority=PRIORITY_NAMES[GROUP])
+        return True
+
+    async def _acquire(self, user_id: Hashable, priority: int):
+        if not self.buckets.take(user_id):
+            self._reject("rate_limited", priority)
+        if self.active < self.max_active and not self.depth:
+            self.active += 1
+            DECISIONS.inc(result="admitted", priority=PRIORITY_NAMES[priority])
+            return
+        if self.depth >= self.queue_size and not (priority == PRIVATE and self._preempt_group_waiter()):
+            self._reject("queue_full", priority)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrivals), future))
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            # Unless a slot was handed over in the same instant, in which case it is used
+            if future.cancel() or future.exception() is not None:
+                self._reject("timeout", priority)
+        except BaseException:
+            # A slot handed over just as the waiter was cancelled goes to the next one in line
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            else:
+                future.cancel()
+            raise
+        QUEUE_WAIT.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+        DECISIONS.inc(result="admitted", priority=PRIORITY_NAMES[priority])
+
+    def _release(self):
+        # Hand the slot straight to the next live waiter, it stays counted in `active`
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def admit(self, user_id: Hashable, priority: int = PRIVATE):
+        await self._acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {"active": self.active, "queued": self.depth, "users": len(self.buckets)}
+
+
+admission = AdmissionController()
+
+Gauge("elyuf_admission_queue_depth", "RAG requests waiting for a slot", function=lambda: admission.depth)
+Gauge("elyuf_admission_active", "RAG requests holding a slot", function=lambda: admission.active)
@@ -1,9 +1,18 @@
 import re
-from rag.query_util import query_index
+import time
+from rag.query_util import query_engine, get_llm
+from rag.query_engine import QueryTimeoutError, RAG_TIMEOUT
+from rag.shortlist import parse_shortlist, resolve_with_llm, format_shortlist
+from rag.ranking_index import aget_ranking_index, format_answer
+from rag.precompute import precomputed_answers
 import os, dotenv, logging
-from data import load_data
 from datetime import datetime
-from user_database import registered_users, user_data, collection, load_registered_users
+from user_database import user_registry, user_store
+from usage_counters import usage_counters
+from telegram_src.streaming import stream_reply, STREAM_ANSWERS, TIMEOUT_TEXT
+from telegram_src.admission import admission, AdmissionRejected, PRIVATE, GROUP
+from metrics import MESSAGES, MESSAGE_ERRORS, MESSAGE_LATENCY, IN_FLIGHT, STAGE_LATENCY
+from logging_pipeline import log_event
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ConversationHandler,
@@ -18,10 +27,7 @@ BOT_USERNAME = os.getenv("BOT_USERNAME")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID"))
 
-# Logging setup
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# Logging is configured by logging_pipeline.setup_logging() at startup, records carry the update's trace ID
 logger = logging.getLogger(__name__)
 
 # Conversation states
@@ -32,20 +38,23 @@ START, NAME, PHONE, ADMIN, NEW_REGISTRATION = range(5)
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     user_name = update.message.from_user.username
-    if user_id in registered_users:
+    if not user_registry.loaded and not user_registry.known(user_id):
+        # Only until the startup warm-up has loaded the registered IDs; the restored snapshot answers for known users
+        await user_registry.aensure_loaded()
+    if user_registry.known(user_id):
         await update.message.reply_text(
             "You are already registered! Which university do you want to look up?"
         )
         return ConversationHandler.END
 
-    user_data[user_id] = {"username": user_name}
+    # The profile is collected in the per-user conversation data until the phone number arrives
+    context.user_data["registration"] = {"username": user_name}
     await update.message.reply_text("Welcome! Please enter your name:")
     return NAME
 
 # Function to handle name input
 async def name(update: Update, context: CallbackContext):
-    user_id = update.message.from_user.id
-    user_data[user_id]["name"] = update.message.text
+    context.user_data.setdefault("registration", {})["name"] = update.message.text
     
     button = KeyboardButton("📞✅ Share Phone Number 📞✅", request_contact=True)
     reply_markup = ReplyKeyboardMarkup([[button]], one_time_keyboard=True, resize_keyboard=False)
@@ -64,7 +73,8 @@ async def phone(update: Update, context: CallbackContext):
         
     signup_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-    user_data[user_id].update({
+    profile = context.user_data.pop("registration", {})
+    profile.update({
         "phone_number": phone_number,
         "signup_datetime": signup_datetime,
         "search_count": 0,
@@ -72,8 +82,8 @@ async def phone(update: Update, context: CallbackContext):
         "survey_count": 0
     })
     
-    collection.update_one({"_id": user_id}, {"$set": user_data[user_id]}, upsert=True)
-    registered_users.append(user_id)
+    await user_store.upsert_profile(user_id, profile)
+    user_registry.add(user_id)
     start_text = """
 🎓 Thank you! Which university do you want to look up? 📚
 
@@ -155,13 +165,67 @@ async def restart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 
+# Answer plain rank lookups straight from the ranking index, None when the RAG chain is needed
+async def answer_from_index(text: str):
+    ranking_index = await aget_ranking_index()
+    with STAGE_LATENCY.time(stage="ranking_index"):
+        match = ranking_index.lookup(text)
+    if match is not None and match.confident:
+        logger.info("Answered from ranking index (%s, %.2f): %s", match.method, match.score, match.record.name)
+        # The batch job's Gemini answer when it is current for this university's ranks, else the plain ranks
+        answer = precomputed_answers.get(match.record)
+        return answer if answer is not None else format_answer(match.record)
+    return None
+
+# Answer a message listing several universities with one table, None when it isn't such a list
+async def answer_shortlist(text: str, user_id: int, priority: int):
+    shortlist = parse_shortlist(text, await aget_ranking_index())
+    if shortlist is None:
+        return None
+    if shortlist.unresolved:
+        # Names the index couldn't resolve are settled together, with at most one LLM call,
+        # admitted like any other Gemini lookup
+        try:
+            async with admission.admit(user_id, priority):
+                await resolve_with_llm(shortlist, get_llm, RAG_TIMEOUT)
+        except AdmissionRejected as e:
+            # The names the index resolved are still answered, the others are listed as not found
+            logger.warning("Skipped the shortlist LLM call for user %s: %s", user_id, e.reason)
+    logger.info("Answered a shortlist of %d names", len(shortlist.items))
+    return format_shortlist(shortlist)
+
 # Creating Function to handle message requests using RAG model
-def handle_response(text: str) -> str:
-    return query_index(text)
+async def handle_response(text: str, check_cache: bool = True) -> str:
+    answer = await answer_from_index(text)
+    if answer is not None:
+        return answer
+    return await query_engine.query(text, check_cache=check_cache)
+
+# Paths of lookups that timed out or failed: the user got an apology, not an answer
+FAILED_PATHS = ("timeout", "error")
+
+# Sent instead of an answer when the bot is overloaded or the user is sending too fast
+BUSY_REPLIES = {
+    "rate_limited": "🐢 You're sending questions a little too fast. Please wait a few seconds and ask again!",
+    "default": "🚦 I'm answering a lot of questions right now. Please try again in a minute!",
+}
+
+# Inline keyboard attached to every answer
+def build_answer_markup() -> InlineKeyboardMarkup:
+    # Creating telega.ai Inline Button for Affilitate program
     
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):       # Function to handle messages
-    logger.info("Received update: %s", update)
+    # Creating an inline keyboard for Pollfish Survey
+    survey_keyboard = [[InlineKeyboardButton("💡✅ Take Survey 🚀🎯", url="https://wss.pollfish.com/link/16d14b3f-cdd1-4313-be52-d281b2ae3e6b")]]
+    pollfish_markup = InlineKeyboardMarkup(survey_keyboard)
     
+    # Created an inline for unicraft.uz as collabration request
+    roadmap_keyboard = [[InlineKeyboardButton("🛣🛫 EYUF Application roadmap ✨🗺", url="https://unicraft.uz/roadmaps/eyuf?utm_source=eyufbot")]]
+    roadmap_markup = InlineKeyboardMarkup(roadmap_keyboard)
+    
+    # Combine the keyboards
+    return InlineKeyboardMarkup(pollfish_markup.inline_keyboard + roadmap_markup.inline_keyboard)
+    
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):       # Function to handle messages
     try:
         message_type: str = update.message.chat.type
         user_id = update.message.from_user.id
@@ -171,56 +235,74 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if current_state in [NAME, PHONE, ADMIN]:
             return
 
-        print(f'User ({update.message.chat.id}) in {message_type}: "{text}"')
+        log_event(logger, "message_received", chat_id=update.message.chat.id, chat_type=message_type,
+                  user_id=user_id, text=text[:200])
     
         if message_type in ["group", "supergroup", "channel"]:
             if BOT_USERNAME in text:
-                new_text = re.sub(f'@{BOT_USERNAME}', '', text, flags=re.IGNORECASE).strip()
-                response: str = handle_response(new_text,)
+                query = re.sub(f'@{BOT_USERNAME}', '', text, flags=re.IGNORECASE).strip()
             else:
                 return
         else:
-            response: str = handle_response(text, )
+            query = text
+
+        started = time.perf_counter()
+        with IN_FLIGHT.track_inprogress():
+            combined_markup = build_answer_markup()
+            # Gemini lookups go through admission control, private chats ahead of group mentions
+            priority = PRIVATE if message_type == "private" else GROUP
+            response = await answer_shortlist(query, user_id, priority)
+            path = "shortlist"
+            if response is None:
+                response = await answer_from_index(query)
+                path = "index" if response is not None else "rag"
+            if response is None:
+                response = await query_engine.cached(query)
+                path = "cache" if response is not None else path
+            sent = False
+            if response is None:
+                try:
+                    async with admission.admit(user_id, priority):
+                        if STREAM_ANSWERS:
+                            # Show the answer while Gemini is still writing it, the last edit adds the inline buttons
+                            response, failure = await stream_reply(
+                                update.message, query_engine.stream(query, check_cache=False), combined_markup)
+                            path, sent = failure or "stream", True
+                        else:
+                            # The cache was checked above, before admission
+                            response = await handle_response(query, check_cache=False)
+                except AdmissionRejected as e:
+                    logger.warning("Shed a request from user %s: %s", user_id, e.reason)
+                    path = "shed"
+                    response = BUSY_REPLIES.get(e.reason, BUSY_REPLIES["default"])
+                    combined_markup = None
+                except QueryTimeoutError:
+                    path = "timeout"
+                    response = TIMEOUT_TEXT
+                    combined_markup = None
+            if not sent:
+                # Sending the response with the combined inline button
+                with STAGE_LATENCY.time(stage="telegram_send"):
+                    await update.message.reply_text(response, reply_markup=combined_markup)
+        elapsed = time.perf_counter() - started
+        MESSAGES.inc(path=path)
+        MESSAGE_LATENCY.observe(elapsed, path=path)
+        if path in FAILED_PATHS:
+            MESSAGE_ERRORS.inc()
             
     except Exception as e:
-        logger.error("Error in message handler: %s", e)
-
-    print("Bot:", response)
-    
-    
-    # Creating telega.ai Inline Button for Affilitate program
-    
-    # Creating an inline keyboard for Pollfish Survey
-    survey_keyboard = [[InlineKeyboardButton("💡✅ Take Survey 🚀🎯", url="https://wss.pollfish.com/link/16d14b3f-cdd1-4313-be52-d281b2ae3e6b")]]
-    pollfish_markup = InlineKeyboardMarkup(survey_keyboard)
-    
-    # Created an inline for unicraft.uz as collabration request
-    roadmap_keyboard = [[InlineKeyboardButton("🛣🛫 EYUF Application roadmap ✨🗺", url="https://unicraft.uz/roadmaps/eyuf?utm_source=eyufbot")]]
-    roadmap_markup = InlineKeyboardMarkup(roadmap_keyboard)
-    
-    # Combine the keyboards
-    combined_markup = InlineKeyboardMarkup(pollfish_markup.inline_keyboard + roadmap_markup.inline_keyboard)
-    
-    # Sending the response with the combined inline button
-    await update.message.reply_text(response, reply_markup=combined_markup)
-
-    try:
-        # Unicraft Roadmap Inline button
-        if user_id in user_data:
-            user_data[user_id]["roadmap_presses"] = user_data[user_id].get("roadmap_presses", 0) + 1
-            collection.update_one({"_id": user_id}, {"$set": {"roadmap_presses": user_data[user_id]["roadmap_presses"]}})
-
-        # search_count Inline button
-        if user_id in user_data:
-            user_data[user_id]["search_count"] = user_data[user_id].get("search_count", 0) + 1
-            collection.update_one({"_id": user_id}, {"$set": {"search_count": user_data[user_id]["search_count"]}})
-
-        # Pollfish Survey Inline button
-        if user_id in user_data:
-            user_data[user_id]["survey_count"] = user_data[user_id].get("survey_count", 0) + 1
-            collection.update_one({"_id": user_id}, {"$set": {"survey_count": user_data[user_id]["survey_count"]}})
-    except Exception as e:
-        logger.error(f"Error updating user data: {e}")
+        MESSAGE_ERRORS.inc()
+        logger.error("Error in message handler: %s", e, exc_info=True)
+        return
+
+    log_event(logger, "message_answered", path=path, seconds=round(elapsed, 3), response_length=len(response))
+    if path == "shed" or path in FAILED_PATHS:
+        # Only answered searches are counted
+        return
+
+    # Usage counters are buffered and written to Mongo in batches, the reply never waits on them.
+    # The $inc doesn't upsert, so it's a no-op for users who never registered.
+    usage_counters.increment(user_id, roadmap_presses=1, search_count=1, survey_count=1)
     
     
 # Function to handle errors
@@ -0,0 +1,286 @@
+"""Local state that survives restarts, in one SQLite file in WAL mode.
+
+`SQLitePersistence` is the application's persistence: conversation states, user_data, chat_data
+and bot_data. The application hands it changes every PERSISTENCE_INTERVAL seconds, and the
+changes of one round are written in a single transaction.
+
+`StateSnapshots` saves the registered user IDs and the answer cache every STATE_SNAPSHOT_INTERVAL
+seconds and on shutdown. At startup they are restored in the background, in chunks of
+STATE_RESTORE_CHUNK rows with the most recently used answers first, so the bot starts serving
+right away and the caches fill up within seconds. Answers cached for an older build of the
+embeddings are not restored.
+"""
+import os
+import json
+import time
+import pickle
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import dotenv
+from telegram.ext import BasePersistence, PersistenceInput
+
+from metrics import Counter
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Persistence configuration
+BOT_STATE_PATH = os.getenv("BOT_STATE_PATH", os.path.join(REPO_ROOT, "data", "bot-state.sqlite3"))  # Empty to disable
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))  # Seconds between conversation state writes
+STATE_SNAPSHOT_INTERVAL = float(os.getenv("STATE_SNAPSHOT_INTERVAL", "60"))  # Seconds between cache snapshots
+STATE_RESTORE_CHUNK = int(os.getenv("STATE_RESTORE_CHUNK", "500"))  # Rows restored per step at startup
+FLUSH_DELAY = 0.2  # Changes arriving within this window go into the same transaction
+
+STATE_WRITES = Counter("elyuf_state_writes_total", "Rows written to the local state store", ["namespace"])
+
+_DELETE = object()
+
+
+class StateStore:
+    """Namespaced key/value rows in SQLite. Safe to share between threads."""
+
+    def __init__(self, path: str = BOT_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, position REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS state_position ON state (namespace, position)")
+
+    def load(self, namespace: str) -> Dict[str, bytes]:
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return dict(rows)
+
+    def chunks(self, namespace: str, size: int) -> Iterator[List[Tuple[str, bytes]]]:
+        """Rows of a namespace by ascending position, `size` at a time."""
+        last = None
+        while True:
+            with self._lock:
+                if last is None:
+                    rows = self._conn.execute(
+                        "SELECT key, value, position FROM state WHERE namespace = ? ORDER BY position, key LIMIT ?",
+                        (namespace, size)).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT key, value, position FROM state WHERE namespace = ? AND (position, key) > (?, ?)"
+                        " ORDER BY position, key LIMIT ?", (namespace, last[0], last[1], size)).fetchall()
+            if not rows:
+                return
+            last = (rows[-1][2], rows[-1][0])
+            yield [(key, value) for key, value, _ in rows]
+
+    def write(self, changes: Dict[Tuple[str, str], object], replace: Tuple[str, ...] = ()):
+        """Upsert (namespace, key) -> value, or delete it when the value is _DELETE, in one transaction.
+        Namespaces listed in `replace` are emptied first. Values may be (value, position) pairs."""
+        upserts, deletes = [], []
+        for (namespace, key), value in changes.items():
+            if value is _DELETE:
+                deletes.append((namespace, key))
+            else:
+                value, position = value if isinstance(value, tuple) else (value, 0)
+                upserts.append((namespace, key, value, position))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for namespace in replace:
+                    self._conn.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+                self._conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                self._conn.executemany(
+                    "INSERT INTO state (namespace, key, value, position) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, position = excluded.position",
+                    upserts,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        counts = defaultdict(int)
+        for namespace, _ in changes:
+            counts[namespace] += 1
+        for namespace, count in counts.items():
+            STATE_WRITES.inc(count, namespace=namespace)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SQLitePersistence(BasePersistence):
+    """Application persistence on a StateStore: conversations, user_data, chat_data and bot_data.
+
+    Callback data isn't stored, the bot's inline buttons are plain URLs."""
+
+    def __init__(self, store: StateStore, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self.store = store
+        self._pending: Dict[Tuple[str, str], object] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def _queue(self, namespace: str, key: str, value):
+        self._pending[(namespace, key)] = _DELETE if value is _DELETE else pickle.dumps(value)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # The application updates every changed conversation and user one after the other, wait for the round to end
+        await asyncio.sleep(FLUSH_DELAY)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        if not self._pending:
+            return
+        changes, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self.store.write, changes)
+        except sqlite3.Error as e:
+            logger.error("Could not write %d state changes: %s", len(changes), e)
+
+    def _load(self, namespace: str) -> dict:
+        return {key: pickle.loads(value) for key, value in self.store.load(namespace).items()}
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {int(key): value for key, value in self._load("user_data").items()}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {int(key): value for key, value in self._load("chat_data").items()}
+
+    async def get_bot_data(self) -> dict:
+        return self._load("bot_data").get("bot_data", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        conversations = {}
+        for key, state in self._load(f"conversation:{name}").items():
+            # Keys are tuples of chat and user IDs, stored as JSON lists
+            conversations[tuple(json.loads(key))] = state
+        return conversations
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._queue(f"conversation:{name}", json.dumps(list(key)), _DELETE if new_state is None else new_state)
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._queue("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._queue("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data: dict):
+        self._queue("bot_data", "bot_data", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._queue("user_data", str(user_id), _DELETE)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._queue("chat_data", str(chat_id), _DELETE)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict):
+        pass
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_pending()
+
+
+class StateSnapshots:
+    """Periodic snapshots of the user registry and the answer cache, restored in chunks at startup."""
+
+    def __init__(self, store: StateStore, registry, answer_cache, interval: float = STATE_SNAPSHOT_INTERVAL,
+                 chunk: int = STATE_RESTORE_CHUNK):
+        self.store = store
+        self.registry = registry
+        self.answer_cache = answer_cache
+        self.interval = interval
+        self.chunk = chunk
+        self._saved_ids: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    async def restore(self):
+        started = time.perf_counter()
+        restored_ids = restored_answers = 0
+        for rows in self.store.chunks("registry", self.chunk):
+            ids = [int(key) for key, _ in rows]
+            self.registry.restore(ids)
+            self._saved_ids.update(ids)
+            restored_ids += len(ids)
+            # Let updates be handled between chunks
+            await asyncio.sleep(0)
+        meta = self.store.load("meta")
+        version = pickle.loads(meta["embeddings_version"]) if "embeddings_version" in meta else None
+        if version == self.answer_cache.embeddings_version:
+            for rows in self.store.chunks("answers", self.chunk):
+                restored_answers += self.answer_cache.restore(pickle.loads(value) for _, value in rows)
+                await asyncio.sleep(0)
+        logger.info("Restored %d registered users and %d cached answers in %.2fs",
+                    restored_ids, restored_answers, time.perf_counter() - started)
+
+    def collect(self) -> Tuple[set, list, object]:
+        """Copy what to save: runs on the event loop, the only writer of the registry and the cache."""
+        return self.registry.snapshot(), list(self.answer_cache.export()), self.answer_cache.embeddings_version
+
+    def write(self, ids: set, answers: list, embeddings_version):
+        """Write the registry IDs added since the last save, and replace the answer snapshot.
+        Gets copies from `collect`, so it can run in a thread."""
+        changes: Dict[Tuple[str, str], object] = {("registry", str(user_id)): b"" for user_id in ids - self._saved_ids}
+        # Positions keep the most recently used answers first for the restore
+        for position, entry in enumerate(answers):
+            changes[("answers", entry[0])] = (pickle.dumps(entry), position)
+        changes[("meta", "embeddings_version")] = pickle.dumps(embeddings_version)
+        self.store.write(changes, replace=("answers",))
+        self._saved_ids |= ids
+
+    async def save(self):
+        await asyncio.to_thread(self.write, *self.collect())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.save()
+            except Exception:
+                # Keep snapshotting, the next round writes everything again
+                logger.exception("Could not save the state snapshot")
+
+    async def start(self):
+        try:
+            await self.restore()
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            logger.error("Could not restore the state snapshot, starting cold: %s", e)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.save()
+        except Exception:
+            logger.exception("Could not save the state snapshot")
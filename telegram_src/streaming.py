@@ -0,0 +1,84 @@
+import os
+import asyncio
+import logging
+from typing import AsyncIterator, Optional, Tuple
+
+import dotenv
+from telegram import InlineKeyboardMarkup, Message
+from telegram.constants import ChatAction, MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from rag.query_engine import QueryTimeoutError
+from metrics import STAGE_LATENCY
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Streaming configuration
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") == "1"  # Show RAG answers while Gemini is still generating them
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.2"))  # Seconds between edits of the same message
+
+PLACEHOLDER_TEXT = "🔎 Looking it up..."
+TIMEOUT_TEXT = "⏳ Sorry, the lookup is taking too long right now. Please try again in a moment!"
+ERROR_TEXT = "😔 Sorry, something went wrong while looking that up. Please try again!"
+
+
+def _fit(text: str) -> str:
+    limit = MessageLimit.MAX_TEXT_LENGTH
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+async def _edit(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> float:
+    """Edit the message and return how many seconds Telegram wants us to wait before the next edit."""
+    try:
+        await message.edit_text(_fit(text), reply_markup=reply_markup)
+    except RetryAfter as e:
+        return float(e.retry_after)
+    except BadRequest as e:
+        # Editing to identical text is rejected, which is harmless here
+        if "not modified" not in str(e).lower():
+            raise
+    return 0.0
+
+
+async def stream_reply(message: Message, chunks: AsyncIterator[str],
+                       reply_markup: InlineKeyboardMarkup) -> Tuple[str, Optional[str]]:
+    """Answer `message` with a placeholder and keep editing it as chunks of the answer arrive.
+
+    Intermediate edits are throttled to one per STREAM_EDIT_INTERVAL, and further while Telegram asks
+    us to back off. The final edit carries the complete answer and the inline keyboard. Returns the
+    text that was sent, and "timeout" or "error" when the lookup failed (None when it didn't)."""
+    await message.chat.send_action(ChatAction.TYPING)
+    with STAGE_LATENCY.time(stage="telegram_send"):
+        reply = await message.reply_text(PLACEHOLDER_TEXT)
+
+    loop = asyncio.get_running_loop()
+    next_edit = loop.time() + STREAM_EDIT_INTERVAL
+    text, shown = "", PLACEHOLDER_TEXT
+    failure = None
+    try:
+        async for chunk in chunks:
+            text += chunk
+            if loop.time() >= next_edit and text.strip() and text != shown:
+                backoff = await _edit(reply, text)
+                if not backoff:
+                    shown = text
+                next_edit = loop.time() + max(STREAM_EDIT_INTERVAL, backoff)
+    except QueryTimeoutError:
+        failure = "timeout"
+        text = f"{text}\n\n{TIMEOUT_TEXT}" if text.strip() else TIMEOUT_TEXT
+    except Exception as e:
+        logger.error("Error while streaming an answer: %s", e)
+        failure = "error"
+        text = f"{text}\n\n{ERROR_TEXT}" if text.strip() else ERROR_TEXT
+
+    # The last edit must go through, it's the one with the complete answer and the keyboard
+    for _ in range(3):
+        with STAGE_LATENCY.time(stage="telegram_edit"):
+            backoff = await _edit(reply, text, reply_markup=reply_markup)
+        if not backoff:
+            break
+        await asyncio.sleep(backoff)
+    return text, failure
@@ -0,0 +1,186 @@
+"""Multi-process mode: one supervisor receives updates and shards them over BOT_WORKERS workers.
+
+The supervisor runs the updater (polling or webhook) and nothing else. Every update goes to the
+worker `user_id % BOT_WORKERS` (the chat ID when there is no user) over a multiprocessing queue, so
+one user's updates always reach the same worker, in order, and their ConversationHandler state
+lives there. Each worker is a full bot application built by main.build_application without an
+updater, with its own RAG chain, caches and usage counters. A worker that dies is started again
+with its queue intact; the updates it was processing when it died are lost.
+
+The supervisor serves its metrics on METRICS_PORT and worker N (counting from 0) on METRICS_PORT + N + 1.
+"""
+import os
+import time
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Callable, List, Optional
+
+import dotenv
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+from metrics import Counter, Gauge, metrics_service
+from logging_pipeline import setup_logging
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Supervisor configuration
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # Worker processes, 1 runs the bot in a single process
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "1"))  # Seconds before restarting a dead worker, doubled per crash
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "10"))  # Seconds a worker gets to finish on shutdown
+
+DISPATCHED = Counter("elyuf_supervisor_dispatched_total", "Updates handed to worker processes", ["worker"])
+RESTARTS = Counter("elyuf_supervisor_worker_restarts_total", "Worker processes restarted after dying", ["worker"])
+
+
+def shard_for(update: Update, workers: int) -> int:
+    """The worker an update belongs to: by user, else by chat, else the first worker."""
+    if update.effective_user is not None:
+        return update.effective_user.id % workers
+    if update.effective_chat is not None:
+        return update.effective_chat.id % workers
+    return 0
+
+
+async def _serve_queue(index: int, updates):
+    # Imported in the worker only, the supervisor never loads the handlers or the RAG chain
+    from main import build_application
+    from telegram_src.persistence import BOT_STATE_PATH
+
+    if metrics_service.port:
+        metrics_service.port += index + 1
+    # Each worker keeps the state of its own users, in its own file
+    app = build_application(with_updater=False, state_path=f"{BOT_STATE_PATH}.worker{index}" if BOT_STATE_PATH else "")
+    loop = asyncio.get_running_loop()
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        logger.info("Worker %d ready", index)
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            # The application's own update fetcher hands it to the update processor and the handlers
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        # Processes the updates still queued before returning
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+    logger.info("Worker %d stopped", index)
+
+
+def worker_main(index: int, updates):
+    """Entry point of a worker process."""
+    # Ctrl+C reaches the whole process group; workers are stopped by the supervisor through their queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(worker=index)
+    asyncio.run(_serve_queue(index, updates))
+
+
+class WorkerPool:
+    """The worker processes, one update queue each, restarted when they die.
+
+    `target(index, queue)` is the worker entry point; it reads update dicts from the queue until it
+    gets None."""
+
+    def __init__(self, workers: int = BOT_WORKERS, target: Callable = worker_main,
+                 restart_delay: float = WORKER_RESTART_DELAY):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        # spawn rather than fork: the supervisor's event loop and threads must not be copied into workers
+        self._context = multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self._crashes = [0] * workers
+        self._started_at = [0.0] * workers
+        self._restart_at = [0.0] * workers
+        self._stopping = False
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=self.target, args=(index, self.queues[index]),
+                                        name=f"bot-worker-{index}", daemon=False)
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info("Started worker %d (pid %d)", index, process.pid)
+
+    def start(self):
+        for index in range(self.workers):
+            self._spawn(index)
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    def dispatch(self, update: Update):
+        index = shard_for(update, self.workers)
+        self.queues[index].put(update.to_dict())
+        DISPATCHED.inc(worker=str(index))
+
+    def _restart_delay(self, index: int) -> float:
+        return min(self.restart_delay * 2 ** (self._crashes[index] - 1), WORKER_RESTART_MAX_DELAY)
+
+    async def _monitor(self):
+        while not self._stopping:
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    # A worker that ran for a minute before dying starts the backoff over
+                    self._crashes[index] = 1 if now - self._started_at[index] > 60 else self._crashes[index] + 1
+                    self._restart_at[index] = now + self._restart_delay(index)
+                    logger.error("Worker %d (pid %d) exited with code %s, restarting in %.0fs",
+                                 index, process.pid, process.exitcode, self._restart_at[index] - now)
+                    process.close()
+                    self.processes[index] = None
+                    RESTARTS.inc(worker=str(index))
+                elif process is None and now >= self._restart_at[index]:
+                    self._spawn(index)
+            await asyncio.sleep(0.5)
+
+    def backlog(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def stop(self, timeout: float = WORKER_STOP_TIMEOUT):
+        self._stopping = True
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Worker %d did not stop within %.0fs, terminating it", index, timeout)
+                process.terminate()
+                await asyncio.to_thread(process.join, 5)
+
+
+# Build the supervisor application: it only receives updates and passes them to the workers
+def build_supervisor_application(token: str, workers: int = BOT_WORKERS) -> Application:
+    pool = WorkerPool(workers)
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        pool.dispatch(update)
+
+    async def post_init(application: Application):
+        await metrics_service.start()
+        pool.start()
+
+    async def post_shutdown(application: Application):
+        await pool.stop()
+        await metrics_service.stop()
+
+    app = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown).build()
+    app.add_handler(TypeHandler(Update, forward))
+    Gauge("elyuf_supervisor_backlog", "Updates waiting in the worker queues", function=pool.backlog)
+    return app
@@ -0,0 +1,61 @@
+import asyncio
+from typing import Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from logging_pipeline import trace
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each user's updates in order.
+
+    Updates are serialized on a key, the sending user or else the chat, so the steps of one user's
+    registration conversation never overlap, while different users are processed in parallel up to
+    `max_concurrent_updates`. An update waiting for an earlier update with the same key doesn't take
+    one of the concurrency slots."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._queued: Dict[Hashable, int] = {}
+
+    @staticmethod
+    def serialization_key(update: object) -> Optional[Hashable]:
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return ("user", update.effective_user.id)
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = self.serialization_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._queued[key] = self._queued.get(key, 0) + 1
+        try:
+            # asyncio.Lock wakes waiters first-in first-out, so updates keep their arrival order
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._queued[key] -= 1
+            if not self._queued[key]:
+                del self._queued[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        # Everything logged while handling the update, down to retrieval and DB calls, carries its ID
+        with trace(update.update_id if isinstance(update, Update) else id(update)):
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,61 @@
+import pytest
+
+from rag.ranking_index import RankingIndex, RANKING_MATCH_THRESHOLD
+
+
+def _rows(*names):
+    return [{"rank": rank, "university": name, "country": country} for rank, (name, country) in enumerate(names, start=1)]
+
+
+@pytest.fixture(scope="module")
+def index():
+    universities = _rows(
+        ("Massachusetts Institute of Technology (MIT)", "United States"),
+        ("Harvard University", "United States"),
+        ("University of Michigan-Ann Arbor", "United States"),
+        ("University of Washington", "United States"),
+        ("New York University", "United States"),
+        ("The University of Tokyo", "Japan"),
+        ("London School of Economics and Political Science", "United Kingdom"),
+        ("University of California, Berkeley", "United States"),
+    )
+    return RankingIndex.from_sources(universities, universities, universities)
+
+
+@pytest.mark.parametrize("question", [
+    "Michigan State University",
+    "Washington State University",
+    "University of York",
+    "York University",
+    "Tokyo Institute of Technology",
+])
+def test_other_universities_are_not_answered_confidently(index, question):
+    match = index.lookup(question)
+    assert match is None or not match.confident
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("michigan", "University of Michigan-Ann Arbor"),
+    ("University of Washington", "University of Washington"),
+    ("tokyo", "The University of Tokyo"),
+    ("What is the rank of Harvard?", "Harvard University"),
+    ("London School of Economics", "London School of Economics and Political Science"),
+    ("New York University ranking", "New York University"),
+    ("berkeley", "University of California, Berkeley"),
+    ("mit", "Massachusetts Institute of Technology (MIT)"),
+])
+def test_known_universities_are_answered(index, question, expected):
+    match = index.lookup(question)
+    assert match is not None and match.confident
+    assert match.record.name == expected
+
+
+@pytest.mark.parametrize("question", ["Is MIT better than Harvard?", "harvard or new york university"])
+def test_comparisons_are_not_answered_with_one_university(index, question):
+    match = index.lookup(question)
+    assert match is None or not match.confident
+
+
+def test_match_threshold_sits_between_partial_and_confident_scores():
+    from rag.ranking_index import PARTIAL_MATCH_SCORE, COMPARISON_SCORE
+    assert COMPARISON_SCORE < PARTIAL_MATCH_SCORE < RANKING_MATCH_THRESHOLD < 0.9
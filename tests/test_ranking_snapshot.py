@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from ranking_snapshot import RankingSnapshot, compile_snapshot, MAX_PACKED_RANK
+
+
+def _compile(tmp_path, rows):
+    path = tmp_path / "ranks.json"
+    path.write_text(json.dumps({"data": rows}), encoding="utf-8")
+    return RankingSnapshot(compile_snapshot([("qs", str(path))]))
+
+
+@pytest.mark.parametrize("rank", [
+    0, 12, MAX_PACKED_RANK, MAX_PACKED_RANK + 1, 2 ** 40, -3, 12.5, 12.0, True, "=12", "201-250", "12", None,
+])
+def test_rank_round_trips_with_its_json_type(tmp_path, rank):
+    rows = [{"rank": rank, "university": "Harvard University", "country": "United States", "score": 99.1}]
+    items = _compile(tmp_path, rows).items(0)
+    assert items == rows
+    assert type(items[0]["rank"]) is type(rank)
+
+
+def test_unpackable_rank_keeps_the_merged_record_rank(tmp_path):
+    rows = [{"rank": 2 ** 40, "university": "Harvard University", "country": "United States"}]
+    snapshot = _compile(tmp_path, rows)
+    assert snapshot.records()[0].ranks == {"qs": str(2 ** 40)}
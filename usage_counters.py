@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from collections import Counter
+from typing import Dict, Optional
+
+import dotenv
+from pymongo.errors import PyMongoError
+
+from user_database import user_store
+from metrics import Gauge
+
+# Load environment variables
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Counter flush configuration
+COUNTERS_FLUSH_INTERVAL = float(os.getenv("COUNTERS_FLUSH_INTERVAL", "10"))  # Seconds between flushes
+COUNTERS_MAX_PENDING = int(os.getenv("COUNTERS_MAX_PENDING", "500"))  # Users with pending deltas that force an early flush
+
+
+class CounterAggregator:
+    """Buffers per-user `$inc` deltas in memory and writes them to Mongo in one bulk_write through the async store.
+
+    `increment` never touches the database, so the reply path doesn't wait on it. A background task
+    flushes the buffer every `flush_interval` seconds, or sooner once `max_pending` users have pending
+    deltas, and `stop` flushes whatever is left on shutdown. A failed flush puts its deltas back."""
+
+    def __init__(self, store, flush_interval: float = COUNTERS_FLUSH_INTERVAL, max_pending: int = COUNTERS_MAX_PENDING):
+        self._store = store
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[int, Counter] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.flushes = 0
+        self.flushed_ops = 0
+
+    @property
+    def backlog(self) -> int:
+        """Number of users with deltas that have not been written yet."""
+        return len(self._pending)
+
+    def increment(self, user_id: int, **fields: int):
+        self._pending.setdefault(user_id, Counter()).update(fields)
+        if len(self._pending) >= self.max_pending and self._wake is not None:
+            self._wake.set()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._store.increment_many(pending)
+        except PyMongoError as e:
+            logger.error("Error flushing usage counters, %d users kept for the next flush: %s", len(pending), e)
+            for user_id, deltas in pending.items():
+                self._pending.setdefault(user_id, Counter()).update(deltas)
+            return
+        self.flushes += 1
+        self.flushed_ops += len(pending)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def start(self):
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Not cancelled: a flush in progress would lose the deltas it already took from the buffer
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            logger.warning("Usage counters for %d users could not be written on shutdown", len(self._pending))
+
+
+# Shared aggregator for the users collection
+usage_counters = CounterAggregator(user_store)
+
+Gauge("elyuf_usage_counters_backlog", "Users with usage counters not written yet", function=lambda: usage_counters.backlog)
@@ -1,34 +1,188 @@
 import os
-import certifi
-from pymongo import MongoClient
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Mapping, Optional
 
 # Load environment variables
 import dotenv
 dotenv.load_dotenv()
 
-# MongoDB configuration
-MONGODB_URI = os.getenv("MONGO_CLIENT")
-
-# MongoDB connection
-ca_cert_path = certifi.where()
-client = MongoClient(MONGODB_URI, tlsCAFile=ca_cert_path)
-db = client["elyufbot"]
-collection = db["users"]
-for db_name in client.list_database_names():
-    print(db_name)
-
-# Global variables to store user data
-registered_users = []
-user_data = {}
-
-# Load registered users from MongoDB
-def load_registered_users():
-    global registered_users, user_data
-    registered_users = [doc["_id"] for doc in collection.find()]
-    user_data = {doc["_id"]: doc for doc in collection.find()}
-    print("Registered Users successfully loaded!")
-    
-load_registered_users()
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, NetworkTimeout, PyMongoError, ServerSelectionTimeoutError
+
+from rag.mongodb_database import get_client, get_async_client, MONGO_OP_TIMEOUT
+from metrics import Counter, STAGE_LATENCY, DB_WRITES
+from logging_pipeline import log_event
+
+logger = logging.getLogger(__name__)
+
+# MongoDB connection, through the client shared with the RAG collection
+def get_users_collection():
+    return get_client()["elyufbot"]["users"]
+
+# The same collection through the asyncio client, for everything the handlers do
+def get_async_users_collection():
+    return get_async_client()["elyufbot"]["users"]
+
+# Retries of an operation that failed with a transient error
+MONGO_RETRIES = int(os.getenv("MONGO_RETRIES", "2"))
+# Loading every registered ID reads the whole collection, so it gets a longer timeout
+MONGO_LOAD_TIMEOUT = float(os.getenv("MONGO_LOAD_TIMEOUT", "60"))
+
+DB_RETRIES = Counter("elyuf_db_retries_total", "Database operations retried after a transient error", ["operation"])
+
+
+def _is_transient(error: PyMongoError, idempotent: bool) -> bool:
+    # A write that isn't idempotent is only retried when it can't have reached the server
+    if isinstance(error, ServerSelectionTimeoutError):
+        return True
+    if not idempotent:
+        return False
+    return isinstance(error, AutoReconnect) or error.has_error_label("RetryableWriteError")
+
+
+class UserStore:
+    """Async access to the users collection, the only way the handlers talk to the database.
+
+    Every operation runs on the asyncio client, so a slow write never stalls other users, and is
+    bounded by `timeout`. Transient failures (a lost connection, a primary stepping down) are retried
+    up to `retries` times with exponential backoff. `$inc` updates are not idempotent, so they are
+    only retried when the server was never reached. Errors that remain are raised as PyMongoError,
+    a timeout as NetworkTimeout."""
+
+    def __init__(self, get_collection, timeout: float = MONGO_OP_TIMEOUT, retries: int = MONGO_RETRIES, backoff: float = 0.2):
+        self._get_collection = get_collection
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _call(self, name: str, operation, idempotent: bool = True, timeout: Optional[float] = None):
+        timeout = timeout or self.timeout
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                with STAGE_LATENCY.time(stage=f"db_{name}"):
+                    try:
+                        result = await asyncio.wait_for(operation(self._get_collection()), timeout)
+                    except asyncio.TimeoutError:
+                        raise NetworkTimeout(f"{name} timed out after {timeout:g}s") from None
+                log_event(logger, "db_call", operation=name, attempt=attempt + 1,
+                          seconds=round(time.perf_counter() - started, 4))
+                return result
+            except PyMongoError as e:
+                if attempt == self.retries or not _is_transient(e, idempotent):
+                    raise
+                DB_RETRIES.inc(operation=name)
+                logger.warning("Retrying %s after a transient error (attempt %d): %s", name, attempt + 1, e)
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def upsert_profile(self, user_id: int, profile: dict):
+        await self._call("register", lambda users: users.update_one({"_id": user_id}, {"$set": profile}, upsert=True))
+        DB_WRITES.inc(operation="register")
+
+    async def find_profile(self, user_id: int) -> Optional[dict]:
+        return await self._call("find_profile", lambda users: users.find_one({"_id": user_id}))
+
+    async def registered_ids(self) -> set:
+        docs = await self._call("registry_load", lambda users: users.find({}, {"_id": 1}).to_list(length=None),
+                                timeout=MONGO_LOAD_TIMEOUT)
+        return {doc["_id"] for doc in docs}
+
+    async def increment_many(self, deltas: Dict[int, Mapping[str, int]]):
+        """Apply per-user `$inc` deltas in one unordered bulk_write."""
+        operations = [UpdateOne({"_id": user_id}, {"$inc": dict(fields)}) for user_id, fields in deltas.items()]
+        if not operations:
+            return
+        await self._call("counter_flush", lambda users: users.bulk_write(operations, ordered=False), idempotent=False)
+        DB_WRITES.inc(len(operations), operation="counters")
+
+
+class UserRegistry:
+    """Registered user IDs for O(1) membership checks.
+
+    Only the IDs are loaded, with an `_id`-only projection, on first use or when `load` is called
+    from the startup warm-up, and new registrations are added incrementally. Profiles are not kept
+    in memory, the bot never reads them back; they live in the collection only."""
+
+    def __init__(self, get_collection, store=None):
+        self._get_collection = get_collection
+        self._store = store
+        self._ids = set()
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        # Created on first use so it binds to the running loop instead of the one at import time
+        self._async_load_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def collection(self):
+        return self._get_collection()
+
+    def __contains__(self, user_id):
+        # Never loads the registry, it would read the whole collection on the event loop
+        return self.known(user_id)
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self._ids)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def load(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            # Registrations added while the IDs were loading are kept
+            self._ids |= {doc["_id"] for doc in self.collection.find({}, {"_id": 1})}
+            self._loaded = True
+        logger.info("Registered Users successfully loaded! (%d users)", len(self._ids))
+
+    async def aensure_loaded(self):
+        """Load the IDs through the async store, for callers on the event loop. Concurrent callers
+        wait for the same load instead of each reading the whole collection."""
+        if self._loaded:
+            return
+        if self._async_load_lock is None:
+            self._async_load_lock = asyncio.Lock()
+        async with self._async_load_lock:
+            if self._loaded:
+                return
+            if self._store is None:
+                await asyncio.to_thread(self.load)
+                return
+            ids = await self._store.registered_ids()
+            if self._loaded:
+                return
+            # Registrations added while the IDs were loading are kept
+            self._ids |= ids
+            self._loaded = True
+        logger.info("Registered Users successfully loaded! (%d users)", len(self._ids))
+
+    def known(self, user_id):
+        """Whether the ID is known to be registered, without loading the registry."""
+        return user_id in self._ids
+
+    def snapshot(self):
+        return set(self._ids)
+
+    def restore(self, ids):
+        """Add IDs saved by an earlier run. The registry still counts as not loaded until `load` ran."""
+        self._ids |= set(ids)
+
+    def add(self, user_id):
+        """Record a new registration without reloading the collection."""
+        self._ids.add(user_id)
+
+
+user_store = UserStore(get_async_users_collection)
+user_registry = UserRegistry(get_users_collection, store=user_store)
 
 # # Load the last 150 registered users from MongoDB
 # def load_last_150_registered_users():